@@ -0,0 +1,142 @@
+# author: Paul Galatic
+#
+# Program to benchmark pipeline stages against recorded data, without touching
+# the Twitter API or the real data directories.
+
+# STD LIB
+import csv
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+# LOCAL LIB
+import gather
+from extern import *
+
+# CONSTANTS
+PAGE_SIZE = 100
+
+class FakeAPI:
+    '''
+    Stands in for tweepy.API. Trends are the names of the recorded topics, and
+    searching a topic serves its recorded tweets one page at a time, sleeping
+    for a fixed latency per page to simulate the network round trip.
+    '''
+    def __init__(self, pages, latency):
+        self.pages = pages
+        self.latency = latency
+
+    @classmethod
+    def from_files(cls, fnames, latency):
+        '''Records pages from CSV files in the GATHER_FIELDNAMES format.'''
+        pages = {}
+        for fname in fnames:
+            topic = ' '.join(os.path.splitext(os.path.basename(fname))[0].split('_'))
+            with open(fname, 'r', newline='', encoding='utf-8') as src:
+                tweets = [{
+                    'full_text': row['text'],
+                    'created_at': row['timestamp'],
+                    'favorite_count': row['fav_count'],
+                    'retweet_count': row['ret_count'],
+                    'user': {'name': row['username'], 'screen_name': row['at_tag']},
+                    'id': row['id'],
+                } for row in csv.DictReader(src)]
+            pages[topic] = [tweets[idx:idx + PAGE_SIZE] for idx in range(0, len(tweets), PAGE_SIZE)]
+        return cls(pages, latency)
+
+    @classmethod
+    def synthetic(cls, num_topics, latency):
+        '''Makes up topics of different lengths, from 1 to num_topics pages.'''
+        pages = {}
+        for topic_idx in range(num_topics):
+            topic = f'#Synthetic{topic_idx}'
+            tweets = [{
+                'full_text': f'{topic} tweet number {idx}',
+                'created_at': 'Thu Oct 17 00:00:00 +0000 2019',
+                'favorite_count': idx % 7,
+                'retweet_count': idx % 3,
+                'user': {'name': 'Synthetic', 'screen_name': 'synthetic'},
+                'id': 10 ** 18 - idx,
+            } for idx in range((topic_idx + 1) * PAGE_SIZE)]
+            pages[topic] = [tweets[idx:idx + PAGE_SIZE] for idx in range(0, len(tweets), PAGE_SIZE)]
+        return cls(pages, latency)
+
+    def trends_place(self, woeid):
+        return [{'trends': [{'name': topic} for topic in self.pages]}]
+
+    def search(self, hashtag, since_id=None, max_id=None):
+        for page in self.pages[hashtag]:
+            time.sleep(self.latency)
+            for tweet in page:
+                if since_id is not None and int(tweet['id']) <= since_id:
+                    continue
+                if max_id is not None and int(tweet['id']) > max_id:
+                    continue
+                yield tweet
+
+def fake_search(api, hashtag, since_id=None, max_id=None):
+    '''Drop-in replacement for gather.search that uses a FakeAPI.'''
+    return api.search(hashtag, since_id, max_id)
+
+def time_gather(api, workers):
+    '''Gathers every topic the fake API knows about into a scratch directory.'''
+    scratch = tempfile.mkdtemp()
+    real_raw_dir = gather.RAW_DIR
+    gather.RAW_DIR = pathlib.Path(scratch)
+    try:
+        start = time.time()
+        gather.trending_tweets(api, None, len(api.pages), workers, search=fake_search)
+        return time.time() - start
+    finally:
+        gather.RAW_DIR = real_raw_dir
+        shutil.rmtree(scratch)
+
+def bench_gather(args):
+    if args.fnames:
+        api = FakeAPI.from_files(args.fnames, args.latency)
+    else:
+        api = FakeAPI.synthetic(args.num_topics, args.latency)
+
+    slowest = max(len(pages) for pages in api.pages.values()) * args.latency
+    sequential = time_gather(api, 1)
+    concurrent = time_gather(api, args.workers)
+
+    log(f'Gathered {len(api.pages)} topics:')
+    log(f'\tslowest_topic:\t{round(slowest, 3)}s')
+    log(f'\tsequential:\t{round(sequential, 3)}s')
+    log(f'\tconcurrent:\t{round(concurrent, 3)}s ({args.workers} workers)')
+
+def parse_args():
+    '''Parses arguments'''
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest='stage')
+
+    gather_ap = sub.add_parser('gather',
+        help='Time sequential and concurrent gathering against a fake search API.')
+    gather_ap.add_argument('fnames', type=str, nargs='*',
+        help='Recorded topic files to serve. If none are given, topics are synthesized.')
+    gather_ap.add_argument('--num_topics', type=int, default=10,
+        help='How many topics to synthesize when no files are given. [10]')
+    gather_ap.add_argument('--latency', type=float, default=0.05,
+        help='Seconds to wait before serving each page. [0.05]')
+    gather_ap.add_argument('--workers', type=int, default=10,
+        help='How many topics to gather at once. [10]')
+    gather_ap.set_defaults(func=bench_gather)
+
+    return ap, ap.parse_args()
+
+def main():
+    '''Driver program'''
+    parser, args = parse_args()
+    if not args.stage:
+        parser.print_help(sys.stdout)
+        return 1
+    log('Starting...')
+    args.func(args)
+    log('...finished.')
+    return 0
+
+if __name__ == '__main__':
+    main()
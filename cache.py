@@ -0,0 +1,87 @@
+#
+# authors:
+#   Paul Galatic
+#
+# description:
+#   Persistent tables for results that are expensive to compute and worth
+#   keeping between runs and topics (spelling corrections, parsed documents
+#   and the like). Each table maps strings to JSON values, or to raw bytes,
+#   and lives in a SQLite database in CACHE_DIR. Writes are buffered and
+#   committed in batches.
+#
+
+# STD LIB
+import json
+import atexit
+import sqlite3
+
+# PROJECT LIB
+from extern import *
+
+# CONSTANTS
+QUERY_VARS = 500 # older SQLite builds allow at most 999 variables per query
+
+_OPEN = []
+
+class Table:
+    '''
+    A persistent mapping from strings to JSON values, or to bytes if binary
+    is set.
+    '''
+    def __init__(self, name, db=CACHE_DB, binary=False):
+        self.name = name
+        self.binary = binary
+        self.conn = sqlite3.connect(str(db))
+        self.conn.execute(f'CREATE TABLE IF NOT EXISTS "{name}" (key TEXT PRIMARY KEY, value {"BLOB" if binary else "TEXT"})')
+        self.conn.commit()
+        self.pending = {}
+        _OPEN.append(self)
+
+    def _encode(self, value):
+        return value if self.binary else json.dumps(value)
+
+    def _decode(self, value):
+        return bytes(value) if self.binary else json.loads(value)
+
+    def get(self, key, default=None):
+        if key in self.pending:
+            return self.pending[key]
+        found = self.conn.execute(f'SELECT value FROM "{self.name}" WHERE key = ?', (key,)).fetchone()
+        return default if found is None else self._decode(found[0])
+
+    def get_many(self, keys):
+        '''Returns a dictionary of the given keys that are in the table.'''
+        keys = list(set(keys))
+        found = {key: self.pending[key] for key in keys if key in self.pending}
+        keys = [key for key in keys if key not in found]
+        for start in range(0, len(keys), QUERY_VARS):
+            chunk = keys[start:start + QUERY_VARS]
+            marks = ', '.join('?' * len(chunk))
+            for key, value in self.conn.execute(
+                    f'SELECT key, value FROM "{self.name}" WHERE key IN ({marks})', chunk):
+                found[key] = self._decode(value)
+        return found
+
+    def put(self, key, value):
+        self.pending[key] = value
+        if len(self.pending) >= CACHE_FLUSH_ROWS:
+            self.flush()
+
+    def put_many(self, items):
+        self.pending.update(items)
+        if len(self.pending) >= CACHE_FLUSH_ROWS:
+            self.flush()
+
+    def flush(self):
+        '''Commits buffered writes to disk.'''
+        if self.pending:
+            with self.conn:
+                self.conn.executemany(
+                    f'INSERT OR REPLACE INTO "{self.name}" (key, value) VALUES (?, ?)',
+                    [(key, self._encode(value)) for key, value in self.pending.items()])
+            self.pending = {}
+
+@atexit.register
+def _flush_all():
+    for table in _OPEN:
+        table.flush()
@@ -10,104 +10,308 @@
 import os
 import csv
 import pdb
+import hashlib
+import itertools
 
 # EXTERNAL LIB
-import autocorrect
 import numpy as np
-from scipy.spatial import distance
-from sklearn.cluster import AgglomerativeClustering
-from sklearn.feature_extraction.text import CountVectorizer
+from scipy import sparse
+from scipy.cluster import hierarchy
+from scipy.spatial.distance import squareform
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import TruncatedSVD
+from sklearn.preprocessing import normalize
+from sklearn.metrics import pairwise_distances
+from sklearn.feature_extraction.text import CountVectorizer, HashingVectorizer, TfidfVectorizer
 
 # PROJECT LIB
+import dedup
+import words
+import rowindex
 from extern import *
 
-def get_stopwords():
-    if not os.path.exists(CACHE_DIR / 'stopwords.flag'):
-        import nltk
-        nltk.download('stopwords')
-        open(CACHE_DIR / 'stopwords.flag', 'w').close()
-    from nltk.corpus import stopwords
-    return set(stopwords.words('english'))
-
-def filter(text, speller):
-    if FILTER_STOPWORDS:
-        stops = get_stopwords()
-        text = ' '.join([word for word in text.split() if word not in stops])
+def filter(row, target=None):
+    '''
+    Normalizes a tweet for clustering. If the topic is given, the tokens come
+    from the shared token cache, so each tweet is only tokenized once.
+    '''
+    if target is None:
+        tokens = words.tokenize(row['text'])
+        if FILTER_STOPWORDS:
+            stops = words.stopwords()
+            tokens = [word for word in tokens if word not in stops]
+    elif FILTER_STOPWORDS:
+        tokens = words.content_words(target, row)
+    else:
+        tokens = words.tokens(target, row)
     if CORRECT_SPELLING:
-        text = speller(text)
-    return text
-
-def find_argcenter(cluster):
-    '''Returns the index of the point closest to the mean of the cluster.'''
-    center = np.mean(cluster, axis=0)
-    closest = None
-    least_dist = 1
-    for idx in range(len(cluster)):
-        dist = distance.cosine(cluster[idx], center)
-        if dist < least_dist:
-            least_dist = dist
-            closest = idx
-    return idx, 1 - least_dist
-
-def agglomerate(samp, corpus): 
+        tokens = [words.correct(word) for word in tokens]
+    return ' '.join(tokens)
+
+def find_argcenters(vectors, labels, weights=None):
+    '''
+    Finds the point closest to the mean of every cluster at once. The cluster
+    means come from a single sparse product of a cluster membership matrix
+    with the vectors, and every point is compared against its own cluster's
+    mean by cosine similarity. Points count weights times towards the means,
+    if weights are given. Returns, for each cluster label, the index of its
+    closest point and that point's similarity to the mean. Labels with no
+    points get -1 and a similarity of 0.
+    '''
+    vectors = sparse.csr_matrix(vectors)
+    num_points = len(labels)
+    num_clusters = labels.max() + 1
+    if weights is None:
+        weights = np.ones(num_points)
+    membership = sparse.csr_matrix(
+        (weights, (labels, np.arange(num_points))),
+        shape=(num_clusters, num_points))
+    sizes = np.bincount(labels, weights, minlength=num_clusters)
+    centers = sparse.diags(1 / np.maximum(sizes, 1)) @ (membership @ vectors)
+
+    # Cosine similarity of each point with its own center.
+    similarity = normalize(vectors).multiply(normalize(centers)[labels]).sum(axis=1)
+    similarity = np.asarray(similarity).ravel()
+
+    # Sort by cluster, most similar first, and take the first of each cluster.
+    order = np.lexsort((-similarity, labels))
+    found = np.bincount(labels, minlength=num_clusters) > 0
+    argcenters = np.full(num_clusters, -1, dtype=np.int64)
+    argcenters[found] = order[np.searchsorted(labels[order], np.flatnonzero(found))]
+    confidences = np.zeros(num_clusters)
+    confidences[found] = similarity[argcenters[found]]
+    return argcenters, confidences
+
+def represent(samp, vectors, labels, weights=None):
+    '''
+    Returns [size, confidence, tweet] for the NUM_CLUSTERS largest clusters,
+    where the tweet is the one closest to the center of its cluster. If the
+    tweets stand for several copies each, their weights give the number of
+    copies, and sizes count every copy. Labels that no tweet was given are
+    not clusters.
+    '''
+    sizes = np.bincount(labels, weights).astype(np.int64)
+    argcenters, confidences = find_argcenters(vectors, labels, weights)
+    largest = [label for label in np.argsort(-sizes, kind='stable') if argcenters[label] >= 0]
+    reps = []
+    for label in largest[:NUM_CLUSTERS]:
+        reps.append([int(sizes[label]), float(confidences[label]), samp[argcenters[label]]])
+    if len(reps) < NUM_CLUSTERS:
+        log(f'WARNING: There were only {len(largest)} cluster(s)!')
+    while len(reps) < NUM_CLUSTERS:
+        # Act as if there were more clusters by picking the first tweet(s).
+        # This only happens if there are very few tweets in a sample, usually
+        # during testing.
+        reps.append([1, 0, samp[len(reps)]])
+    return reps
+
+def complete_linkage(vectors):
+    '''
+    Returns the complete-linkage tree of the vectors over cosine distances, in
+    the form scipy.cluster.hierarchy uses.
+    '''
+    distances = pairwise_distances(vectors, metric='cosine')
+    # Round-off can leave tiny negative or non-zero self distances.
+    np.clip(distances, 0, None, out=distances)
+    np.fill_diagonal(distances, 0)
+    return hierarchy.linkage(squareform(distances, checks=False), method='complete')
+
+def linkage_tree(vectors, corpus):
+    '''
+    Returns complete_linkage(vectors). Building the tree is the expensive part
+    of clustering, so it is saved in CACHE_DIR under a hash of the corpus and
+    reused by every later run on the same tweets, whatever threshold or number
+    of clusters it is cut at.
+    '''
+    key = hashlib.sha1('\n'.join(corpus).encode('utf-8')).hexdigest()[:16]
+    path = CACHE_DIR / f'linkage-complete-cosine-{key}.npy'
+    if os.path.exists(path):
+        return np.load(str(path))
+
+    tree = complete_linkage(vectors)
+    np.save(str(path), tree)
+    return tree
+
+def cut(tree, threshold=None, num_clusters=None):
+    '''
+    Cuts a linkage tree into flat clusters, either so that no cluster joins
+    tweets further apart than threshold, or into at most num_clusters
+    clusters. Returns cluster labels starting from 0.
+    '''
+    if num_clusters:
+        labels = hierarchy.fcluster(tree, num_clusters, criterion='maxclust')
+    else:
+        # Like AgglomerativeClustering, never merge at exactly the threshold.
+        labels = hierarchy.fcluster(tree, np.nextafter(threshold, 0), criterion='distance')
+    return labels - 1
+
+def agglomerate(samp, corpus, weights=None, threshold=DISTANCE_THRESHOLD, num_clusters=None):
     if not os.path.isdir(CACHE_DIR):
         os.mkdir(CACHE_DIR)
 
     # Convert tweets into bags-of-words vectors.
     vectorizer = CountVectorizer()
-    vectors = vectorizer.fit_transform(corpus).todense()
+    vectors = vectorizer.fit_transform(corpus)
 
     # Cluster the vectors using agglomerative clustering over the cosine 
-    # similarity space.
-    log(f'\tClustering {SAMPLE_SIZE} tweets...')
-    clustering = AgglomerativeClustering(
-        n_clusters=None,
-        affinity='cosine', 
-        memory=str(CACHE_DIR),
-        compute_full_tree='auto',
-        linkage='complete', 
-        distance_threshold=DISTANCE_THRESHOLD)
-    clustering.fit(vectors)
-    # Sort the clusters into lists.
+    # similarity space. Copies of a tweet are at distance 0 from each other
+    # and would be merged first anyway, so clustering one of each and
+    # weighting it gives the same clusters (up to the order in which equally
+    # distant tweets are merged).
+    log(f'\tClustering {len(corpus)} tweets...')
+    if len(corpus) < 2:
+        labels = np.zeros(len(corpus), dtype=int)
+    else:
+        labels = cut(linkage_tree(vectors, corpus), threshold, num_clusters)
+
+    # Find the representative tweets with the least distance to the center
+    # of each of the largest clusters.
     log('\tFinding centers...')
-    cluster_points = [[] for idx in range(len(set(clustering.labels_)))]
-    cluster_tweets = [[] for idx in range(len(set(clustering.labels_)))]
-    for idx, (point, label) in enumerate(zip(vectors, clustering.labels_)):
-        cluster_points[label].append(point)
-        cluster_tweets[label].append(samp[idx])
+    return represent(samp, vectors, labels, weights)
 
-    # Sort the lists to find the largest clusters.
-    cluster_points = sorted(cluster_points, key=lambda x: len(x), reverse=True)
-    cluster_tweets = sorted(cluster_tweets, key=lambda x: len(x), reverse=True)
+def sweep(target, thresholds=(), cluster_counts=()):
+    '''
+    Finds reps for a topic at several granularities, building the linkage
+    tree only once. Returns a dictionary from each threshold, and from each
+    cluster count, to the reps found by cutting the tree there.
+    '''
+    samp, weights, _ = dedup.collapse(sample(target))
+    corpus = [filter(row, target) for row in samp]
+    vectors = CountVectorizer().fit_transform(corpus)
+    tree = linkage_tree(vectors, corpus)
+    results = {}
+    for threshold in thresholds:
+        results[threshold] = represent(samp, vectors, cut(tree, threshold=threshold), weights)
+    for num_clusters in cluster_counts:
+        results[num_clusters] = represent(samp, vectors, cut(tree, num_clusters=num_clusters), weights)
+    return results
+    
+def sparse_agglomerate(samp, corpus, weights=None):
+    '''
+    Clusters large corpora without ever building a dense matrix of word counts
+    or of pairwise distances between tweets. Tweets are embedded as sparse
+    TF-IDF vectors and reduced with a truncated SVD. Mini-batch k-means then
+    groups them into a few hundred micro-clusters, and only the centers of
+    those are merged with complete linkage, the same way agglomerate() merges
+    tweets. The cost grows linearly with the number of tweets, so it is given
+    the whole corpus rather than the sample. Returns reps in the same form as
+    agglomerate().
+    '''
+    vectors = TfidfVectorizer().fit_transform(corpus)
+    num_components = max(1, min(SVD_COMPONENTS, vectors.shape[1] - 1, len(corpus) - 1))
+    reduced = TruncatedSVD(n_components=num_components, random_state=0).fit_transform(vectors)
+    reduced = normalize(reduced)
+
+    num_micro = min(MICRO_CLUSTERS, len(corpus))
+    log(f'\tGrouping {len(corpus)} tweets into {num_micro} micro-clusters...')
+    micro = MiniBatchKMeans(n_clusters=num_micro, batch_size=MICRO_BATCH_SIZE, random_state=0)
+    micro_labels = micro.fit_predict(reduced, sample_weight=weights)
+
+    log(f'\tClustering {num_micro} micro-clusters...')
+    if num_micro < 2:
+        center_labels = np.zeros(num_micro, dtype=int)
+    else:
+        center_labels = cut(complete_linkage(micro.cluster_centers_), DISTANCE_THRESHOLD)
+
+    # Find the representative tweets with the least distance to the center of
+    # each of the largest clusters.
+    log('\tFinding centers...')
+    return represent(samp, vectors, center_labels[micro_labels], weights)
+
+def read_batches(target, batch_size):
+    '''Streams the rows of a file in DATA_DIR, batch_size rows at a time.'''
+    with open(str(DATA_DIR / target) + '.csv', 'r', newline='', encoding='utf-8') as src:
+        rdr = csv.DictReader(src)
+        while True:
+            batch = list(itertools.islice(rdr, batch_size))
+            if not batch:
+                break
+            yield batch
+
+def online_cluster(target):
+    '''
+    Clusters every tweet of a topic, not just the sample, while only holding
+    one batch of tweets in memory at a time. Tweets are hashed into fixed-size
+    sparse vectors, so no vocabulary has to be kept, and fed to mini-batch
+    k-means. A second pass assigns each tweet to a cluster, counting cluster
+    sizes and keeping the tweet closest to each center. Returns reps in the
+    same form as agglomerate(), with sizes counted over the whole corpus.
+    '''
+    vectorizer = HashingVectorizer(n_features=ONLINE_FEATURES, alternate_sign=False, norm='l2')
+    kmeans = MiniBatchKMeans(n_clusters=ONLINE_NUM_CLUSTERS, random_state=0)
+
+    def vectorize(batch):
+        # Tokens for the whole corpus would take too much memory to cache.
+        return vectorizer.transform([filter(row) for row in batch])
+
+    log(f'\tFitting {ONLINE_NUM_CLUSTERS} clusters in batches of {ONLINE_BATCH_SIZE}...')
+    pending = []
+    for batch in read_batches(target, ONLINE_BATCH_SIZE):
+        # k-means needs at least one tweet per cluster to get started.
+        pending.extend(batch)
+        if len(pending) >= ONLINE_NUM_CLUSTERS:
+            kmeans.partial_fit(vectorize(pending))
+            pending = []
+    if pending:
+        kmeans.partial_fit(vectorize(pending))
+
+    log('\tAssigning tweets to clusters...')
+    centers = normalize(kmeans.cluster_centers_)
+    sizes = np.zeros(ONLINE_NUM_CLUSTERS, dtype=np.int64)
+    best_similarity = np.full(ONLINE_NUM_CLUSTERS, -np.inf)
+    best_tweet = [None] * ONLINE_NUM_CLUSTERS
+    for batch in read_batches(target, ONLINE_BATCH_SIZE):
+        vectors = vectorize(batch)
+        labels = kmeans.predict(vectors)
+        similarity = np.asarray(vectors @ centers.T)[np.arange(len(batch)), labels]
+        sizes += np.bincount(labels, minlength=ONLINE_NUM_CLUSTERS)
+
+        # The most central tweet of each cluster within this batch.
+        order = np.lexsort((-similarity, labels))
+        firsts = order[np.r_[0, np.flatnonzero(np.diff(labels[order])) + 1]]
+        for idx in firsts:
+            if similarity[idx] > best_similarity[labels[idx]]:
+                best_similarity[labels[idx]] = similarity[idx]
+                best_tweet[labels[idx]] = batch[idx]
 
-    # Find the representative tweets with the least distance to the center
-    # of each cluster.
     reps = []
-    for idx in range(NUM_CLUSTERS):
-        try:
-            argcenter, confidence = find_argcenter(cluster_points[idx])
-            reps.append([len(cluster_tweets[idx]), confidence, cluster_tweets[idx][argcenter]])
-        except IndexError:
-            log(f'WARNING: There were only {len(set(clustering.labels_))} cluster(s)!')
-            # Act as if there were more than two clusters by picking the first 
-            # tweet(s). This only happens if there are very few tweets in a sample,
-            # usually during testing.
-            reps.append([1, 0, samp[idx]])
-    
+    for label in np.argsort(-sizes, kind='stable')[:NUM_CLUSTERS]:
+        if sizes[label] > 0:
+            reps.append([int(sizes[label]), float(best_similarity[label]), best_tweet[label]])
+    if len(reps) < NUM_CLUSTERS:
+        log(f'WARNING: There were only {len(reps)} cluster(s)!')
+        samp = sample(target)
+        while len(reps) < NUM_CLUSTERS:
+            reps.append([1, 0, samp[len(reps)]])
     return reps
-    
+
+def choose_engine(target):
+    '''Picks a clustering engine for a topic, following CLUSTER_ENGINE.'''
+    if CLUSTER_ENGINE != 'auto':
+        return CLUSTER_ENGINE
+    num_rows = rowindex.num_rows(DATA_DIR, target)
+    if num_rows > ONLINE_MIN_TWEETS:
+        return 'online'
+    return 'sparse' if num_rows > DENSE_CLUSTER_LIMIT else 'agglomerative'
+
+def population(target):
+    '''
+    Returns how many tweets the cluster sizes reported for a topic are out of:
+    the whole corpus when it is clustered online or with the sparse engine,
+    the sample otherwise.
+    '''
+    if choose_engine(target) in ('online', 'sparse'):
+        return rowindex.num_rows(DATA_DIR, target)
+    return len(sample(target))
+
 def find_cluster_reps(target, mock):
     log(f'Clustering {target}...')
-    
-    # Checking spelling can help normalize text.
-    speller = autocorrect.Speller(lang='en')
 
     # Open the source data file and use it as a corpus for clustering. While 
     # the corpus is filtered for spelling and stopwords, the original tweets 
     # are presented.
     log('\tReading in data...')
     samp = sample(target)
-    corpus = [filter(row['text'], speller) for row in samp]
     
     # If we're mocking the data, it's very easy. Just return random tweets from
     # the corpus.
@@ -119,9 +323,21 @@ def find_cluster_reps(target, mock):
         reps[1][0] = np.random.randint(SAMPLE_SIZE / 10, SAMPLE_SIZE / 5)
         reps[2][0] = np.random.randint(SAMPLE_SIZE / 10, SAMPLE_SIZE / 5)
         reps = sorted(reps, key=lambda x: x[0], reverse=True)
-    # Otherwise, find reps "the hard way" using clustering.
+    # Otherwise, find reps "the hard way" using clustering. Each distinct text
+    # is clustered once, weighted by how many tweets share it.
     else:
-        reps = agglomerate(samp, corpus)
+        engine = choose_engine(target)
+        if engine == 'online':
+            reps = online_cluster(target)
+        else:
+            if engine == 'sparse':
+                samp = [row for batch in read_batches(target, ONLINE_BATCH_SIZE) for row in batch]
+            unique, weights, _ = dedup.collapse(samp)
+            corpus = [filter(row, target) for row in unique]
+            if engine == 'sparse':
+                reps = sparse_agglomerate(unique, corpus, weights)
+            else:
+                reps = agglomerate(unique, corpus, weights)
     
     log('...done.')
     return reps
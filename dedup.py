@@ -0,0 +1,126 @@
+#
+# authors:
+#   Paul Galatic
+#
+# description:
+#   Collapses duplicate tweets. Trending topics are full of copy-pasted and
+#   templated tweets, so rather than treating every copy as its own point,
+#   later stages work on the distinct texts, each weighted by the number of
+#   tweets it stands for.
+#
+
+# STD LIB
+import re
+import zlib
+import hashlib
+
+# EXTERNAL LIB
+import numpy as np
+
+# PROJECT LIB
+from extern import *
+
+# CONSTANTS
+URLS = re.compile(r'\w+://\S+')
+NON_WORDS = re.compile(r'[^0-9a-z@#\' ]+')
+SPACES = re.compile(r'\s+')
+MINHASH_PRIME = (1 << 61) - 1
+
+def normalize(text):
+    '''
+    Lowercases a tweet and strips the links, punctuation and spacing that
+    tend to differ between copies of it.
+    '''
+    text = URLS.sub(' ', text.lower())
+    text = NON_WORDS.sub(' ', text)
+    return SPACES.sub(' ', text).strip()
+
+def exact_groups(texts, raw=False):
+    '''
+    Labels each text by the first text that is the same once normalized (or,
+    if raw is set, exactly the same). Labels count up from 0 in order of first
+    appearance.
+    '''
+    labels = {}
+    return np.array(
+        [labels.setdefault(hashlib.sha1((text if raw else normalize(text)).encode('utf-8')).digest(), len(labels))
+            for text in texts],
+        dtype=np.int64)
+
+def shingles(text):
+    '''The distinct pairs of consecutive words in a text, hashed to integers.'''
+    words = normalize(text).split()
+    if len(words) < 2:
+        pairs = words
+    else:
+        pairs = [f'{first} {second}' for first, second in zip(words, words[1:])]
+    return np.array(sorted({zlib.crc32(pair.encode('utf-8')) for pair in pairs}), dtype=np.uint64)
+
+def minhash(texts, num_perm=MINHASH_PERMUTATIONS):
+    '''
+    Returns a MinHash signature for each text, one row per text. The fraction
+    of positions at which two signatures agree estimates the Jaccard
+    similarity of the texts' shingles.
+    '''
+    rng = np.random.RandomState(0)
+    mult = rng.randint(1, 1 << 31, num_perm).astype(np.uint64)
+    add = rng.randint(0, 1 << 31, num_perm).astype(np.uint64)
+    signatures = np.full((len(texts), num_perm), MINHASH_PRIME, dtype=np.uint64)
+    for idx, text in enumerate(texts):
+        hashes = shingles(text)
+        if len(hashes):
+            # Shingles and multipliers are below 2^32, so nothing overflows.
+            signatures[idx] = ((np.outer(hashes, mult) + add) % MINHASH_PRIME).min(axis=0)
+    return signatures
+
+def near_groups(texts, threshold=NEAR_DUPLICATE_THRESHOLD, bands=MINHASH_BANDS):
+    '''
+    Labels each text by the first text it is a near-duplicate of, following
+    chains of near-duplicates. Candidate pairs come from locality-sensitive
+    hashing: texts whose signatures match on any one band share a bucket, and
+    are only joined if their signatures agree on at least threshold of all
+    positions.
+    '''
+    signatures = minhash(texts)
+    rows = signatures.shape[1] // bands
+    parent = np.arange(len(texts))
+
+    def root(idx):
+        while parent[idx] != idx:
+            parent[idx] = parent[parent[idx]]
+            idx = parent[idx]
+        return idx
+
+    for band in range(bands):
+        buckets = {}
+        for idx, signature in enumerate(signatures[:, band * rows:(band + 1) * rows]):
+            buckets.setdefault(signature.tobytes(), []).append(idx)
+        for members in buckets.values():
+            first = members[0]
+            for other in members[1:]:
+                if np.mean(signatures[first] == signatures[other]) >= threshold:
+                    low, high = sorted((root(first), root(other)))
+                    parent[high] = low
+    return np.array([root(idx) for idx in range(len(texts))], dtype=np.int64)
+
+def collapse(rows, near=DEDUP_NEAR, exact=False):
+    '''
+    Collapses rows whose texts are the same once normalized (or, if near is
+    set, nearly the same) into the first of them. If exact is set, only rows
+    whose texts are exactly the same are collapsed, for stages like sentiment
+    that read case and punctuation. Returns (unique, weights,
+    groups), where unique is an array of the remaining rows in their original
+    order, weights[i] is the number of rows unique[i] stands for, and groups
+    maps each of the given rows to its row in unique.
+    '''
+    texts = [row['text'] for row in rows]
+    labels = exact_groups(texts, raw=exact)
+    if near and not exact and len(texts):
+        firsts = np.unique(labels, return_index=True)[1]
+        labels = near_groups([texts[idx] for idx in firsts])[labels]
+
+    # Labels are ordered by first appearance, so this keeps the rows in order.
+    _, firsts, groups, weights = np.unique(labels, return_index=True, return_inverse=True, return_counts=True)
+    unique = np.array([rows[idx] for idx in firsts])
+    log(f'\tCollapsed {len(texts)} tweets into {len(unique)} distinct texts.')
+    return unique, weights, groups
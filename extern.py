@@ -10,7 +10,10 @@
 import os
 import csv
 import pdb
+import math
+import hashlib
 import time
+import itertools
 import pathlib
 
 # EXTERNAL LIB
@@ -21,6 +24,8 @@ DEBUG = True
 LOGTIME_FORMAT = '%H:%M:%S'
 SAMPLE_SIZE = 2048
 SAMPLE = None
+SEED = None
+FINGERPRINT_BLOCK = 2 ** 16
 
 RAW_DIR = pathlib.Path('raw/')
 DATA_DIR = pathlib.Path('data/')
@@ -61,12 +66,41 @@ GATHER_FILTER = ' -filter:retweets'
 GATHER_FIELDNAMES = ['index', 'text', 'timestamp', 'fav_count', 'ret_count', 'username', 'at_tag', 'id']
 GATHER_MAX_TWEETS = 10 ** 9
 GATHER_MAX_CHARS = 10 ** 9
+GATHER_WORKERS = 4 # topics gathered at once
+GATHER_CHECKPOINT_ROWS = 100
+
+# Constants for purify.py
+PURIFY_WORKERS = os.cpu_count()
+PURIFY_CHUNK_ROWS = 50000
 
 # Constants for cluster.py
 NUM_CLUSTERS = 3
 DISTANCE_THRESHOLD = 0.925
 CORRECT_SPELLING = False
 FILTER_STOPWORDS = True # used in cluster.py
+CLUSTER_ENGINE = 'auto' # 'agglomerative', 'sparse', 'online' or 'auto'
+DENSE_CLUSTER_LIMIT = 4096 # 'auto' uses the sparse engine, on the whole corpus, above this many tweets
+SVD_COMPONENTS = 100
+MICRO_CLUSTERS = 500 # the sparse engine merges this many groups instead of tweets
+MICRO_BATCH_SIZE = 4096
+ONLINE_MIN_TWEETS = 100000 # 'auto' clusters the whole corpus above this many tweets
+ONLINE_NUM_CLUSTERS = 16
+ONLINE_BATCH_SIZE = 4096
+ONLINE_FEATURES = 2 ** 18
+
+# Constants for dedup.py
+DEDUP_NEAR = False # also collapse near-duplicates, found with MinHash
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16 # LSH bands, each of MINHASH_PERMUTATIONS // MINHASH_BANDS rows
+NEAR_DUPLICATE_THRESHOLD = 0.8 # estimated Jaccard similarity of word pairs
+
+# Constants for words.py
+TOKEN_CACHE_PERSIST = False # save tokens to CACHE_DIR for later runs
+SPELL_CACHE_SIZE = 2 ** 16 # corrected words remembered in memory
+
+# Constants for cache.py
+CACHE_DB = CACHE_DIR / 'cache.sqlite'
+CACHE_FLUSH_ROWS = 1000 # writes buffered before committing
 
 # Constants used for summarize.py
 REPLACE_DICT = {
@@ -85,7 +119,14 @@ REPLACE_DICT = {
     ' i '       : ' I ',
 }
 TEST_WIKI_ARTICLE = 'Albert Einstein'
-NLP_DOC_LENGTH = 400000
+SPACY_BATCH_SIZE = 256 # tweets parsed at a time
+SUMMARIZE_PROCESSES = 1 # parsing processes, more than 1 needs spaCy 2.2+
+SPACY_DOC_CACHE = True # keep parsed docs in CACHE_DIR
+SPACY_CACHE_CHUNK = 4096 # tweets looked up in the doc cache at a time
+DOC_CACHE_EXCLUDE = ['tensor', 'user_data'] # not needed to summarize, and tensors are large
+SUMMARY_ENGINE = 'top' # 'top' summarizes the sample's top tweets, 'stream' the whole corpus
+SUMMARY_MAX_TERMS = 100000 # distinct words counted when streaming, None for no limit
+SUMMARY_CANDIDATES = 1000 # sentences kept when streaming
 REPEAT_THRESHOLD = 0.30
 Q_RANDOM_SEED = 42
 NUM_SENTENCE_SUMMARY = 7
@@ -93,10 +134,17 @@ NUM_SENTENCE_SUMMARY = 7
 # Constants for sentiment.py
 K_START = 6
 K_END = 15
-BEST_K_IDX = 5
 DEFAULT_NUM_CLUSTERS = 8
+K_SELECTION = 'fixed' # 'fixed' (DEFAULT_NUM_CLUSTERS), 'elbow' or 'silhouette'
+SILHOUETTE_SAMPLE = 2048 # tweets the silhouette of each k is measured on
 NEUTRAL_CUTOFF = 0.1
 MAX_PRINTED_CLUSTERS = 3
+SENTIMENT_WORKERS = os.cpu_count()
+SENTIMENT_CHUNK_ROWS = 2048 # most tweets scored at a time by a worker
+SENTIMENT_MIN_CHUNK_ROWS = 256 # fewest, below which a process isn't worth starting
+SENTIMENT_CACHE = True # keep scores in CACHE_DIR
+SENTIMENT_SCORER = 'vader' # 'vader' (the reference analyzer) or 'vector' (vader.py)
+VADER_TOLERANCE = 0.01 # largest difference allowed between the two scorers
 
 def log(*args):
     '''More informative print debugging'''
@@ -104,24 +152,124 @@ def log(*args):
     s = '\t'.join([str(arg) for arg in args])
     print(f'[{t}]: {s}')
 
+def set_seed(seed):
+    '''
+    Seeds the random number generator. The seed is remembered so that work
+    which depends on it, like the sample, can be saved and reused by later
+    runs with the same seed.
+    '''
+    global SEED
+    SEED = seed
+    if seed: np.random.seed(seed)
+
+def fingerprint(path, length=None):
+    '''
+    Returns a short hash identifying the contents of a file, made from its size
+    and its first and last blocks, so that it stays cheap on large files. If a
+    length is given, only the first length bytes of the file are considered,
+    which tells us whether a file that has grown still starts the same way.
+    '''
+    digest = hashlib.sha1()
+    size = os.path.getsize(path) if length is None else length
+    digest.update(str(size).encode('utf-8'))
+    with open(path, 'rb') as src:
+        digest.update(src.read(min(FINGERPRINT_BLOCK, size)))
+        start = max(size - FINGERPRINT_BLOCK, 0)
+        src.seek(start)
+        digest.update(src.read(size - start))
+    return digest.hexdigest()[:16]
+
+def sidecar(directory, target, kind):
+    '''
+    Returns the path of a file that holds extra information about a dataset,
+    kept next to it, e.g. sidecar(RAW_DIR, '#Foo', 'ckpt.json') is
+    raw/#Foo.ckpt.json.
+    '''
+    return directory / f'{target}.{kind}'
+
+def reservoir(items, size, rng=np.random):
+    '''
+    Draws up to size items from an iterable in one pass, without replacement,
+    holding no more than size items in memory. Uses Li's "Algorithm L", which
+    jumps straight to the next item that will enter the reservoir instead of
+    rolling the dice for every item. Randomness comes from rng (np.random by
+    default), so the result is reproducible under a seed. Returns (position,
+    item) pairs in the order they appeared.
+    '''
+    items = enumerate(items)
+    chosen = list(itertools.islice(items, size))
+    if len(chosen) < size or size < 1:
+        return chosen
+    # 1 - random() is in (0, 1], which keeps the logarithms finite.
+    weight = math.exp(math.log(1 - rng.random_sample()) / size)
+    while True:
+        skip = math.floor(math.log(1 - rng.random_sample()) / math.log(1 - weight))
+        item = next(itertools.islice(items, skip, skip + 1), None)
+        if item is None:
+            break
+        chosen[rng.randint(size)] = item
+        weight *= math.exp(math.log(1 - rng.random_sample()) / size)
+    return sorted(chosen, key=lambda pair: pair[0])
+
+def _rows_at(target, positions):
+    '''Reads the rows at the given (sorted) positions of a file in DATA_DIR.'''
+    import store
+    if store.is_fresh(DATA_DIR, target):
+        return store.to_rows(store.load(DATA_DIR, target), positions)
+    wanted = set(positions)
+    rows = []
+    with open(str(DATA_DIR / target) + '.csv', 'r', newline='', encoding='utf-8') as src:
+        rdr = csv.reader(src)
+        header = next(rdr)
+        for pos, row in enumerate(rdr):
+            if pos in wanted:
+                rows.append(dict(zip(header, row)))
+                if len(rows) == len(wanted):
+                    break
+    return rows
+
 def sample(target, size=SAMPLE_SIZE):
     '''
     Returns a sample of rows from a file in DATA_DIR. A sample is only 
     calculated once, and should be re-used between modules. If the corpus is 
     smaller than the sample size, the entire corpus is used as the sample. 
-    Using a sample is mainly beneficial for 
+    Using a sample is mainly beneficial for keeping clustering and
+    summarization tractable on large topics. The file is streamed, so memory
+    use depends on the sample size rather than the size of the corpus.
+
+    The positions of the sampled rows are saved next to the dataset, keyed by
+    the sample size, the seed and a fingerprint of the file, so separate runs
+    (e.g. --cluster and then --sentiment) share the same sample.
     '''
     global SAMPLE
-    try:
-        if SAMPLE == None:
-            with open(str(DATA_DIR / target) + '.csv', 'r', newline='', encoding='utf-8') as src:
-                rdr = csv.DictReader(src)
-                raw = np.array([row for row in rdr])
-            if len(raw) <= size:
-                SAMPLE = raw
-            else:
-                SAMPLE = raw[np.random.choice(raw.shape[0], size)]
-    except ValueError:
-        # Sample already exists.
-        pass
-    return SAMPLE
\ No newline at end of file
+    if SAMPLE is None:
+        import store
+        fname = str(DATA_DIR / target) + '.csv'
+        prefix = f'sample-{size}-{SEED}-'
+        saved = sidecar(DATA_DIR, target, prefix + fingerprint(fname) + '.npy')
+        if os.path.exists(saved):
+            SAMPLE = np.array(_rows_at(target, np.load(str(saved)).tolist()))
+            return SAMPLE
+
+        # A seeded sample gets its own generator, so it doesn't matter whether
+        # it was drawn or loaded as far as the rest of the program goes.
+        rng = np.random.RandomState(SEED) if SEED else np.random
+        if store.is_fresh(DATA_DIR, target):
+            # Only the sampled rows are ever read out of the columnar store.
+            columns = store.load(DATA_DIR, target)
+            positions = [pos for pos, _ in reservoir(range(store.num_rows(columns)), size, rng)]
+            SAMPLE = np.array(store.to_rows(columns, positions))
+        else:
+            with open(fname, 'r', newline='', encoding='utf-8') as src:
+                rdr = csv.reader(src)
+                header = next(rdr)
+                chosen = reservoir(rdr, size, rng)
+            positions = [pos for pos, _ in chosen]
+            SAMPLE = np.array([dict(zip(header, row)) for _, row in chosen])
+
+        # Samples of older versions of the file are no longer any use.
+        for old in os.listdir(DATA_DIR):
+            if old.startswith(f'{target}.{prefix}'):
+                os.remove(DATA_DIR / old)
+        np.save(str(saved), np.array(positions, dtype=np.int64))
+    return SAMPLE
@@ -11,10 +11,13 @@ import os
 import re
 import csv
 import pdb
+import json
 import sys
 import time
 import pprint
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
 
 # EXTERNAL LIB
@@ -28,76 +31,147 @@ from extern import *
 
 def already_downloaded():
     '''
-    Returns the names of files in RAW_DIR, WITHOUT their extensions. Example:
+    Returns the names of topic files in RAW_DIR, WITHOUT their extensions.
+    Sidecar files (checkpoints and the like) are ignored. Example:
     
     raw/
         #ImpeachTrump.csv
+        #ImpeachTrump.ckpt.json
         #WednesdayWisdom.csv
     
     returns: {#ImpeachTrump, #WednesdayWisdom}
     '''
     topics = set()
     for fname in os.listdir(RAW_DIR):
-        topics.add(' '.join(os.path.splitext(fname)[0].split('_')))
+        name, ext = os.path.splitext(fname)
+        if ext == '.csv':
+            topics.add(' '.join(name.split('_')))
     return topics
 
-def trending_tweets(api, woeid, num_topics):
-    
-    # Create the data folder if it doesn't exist.
-    if not os.path.isdir(RAW_DIR):
-        os.mkdir(RAW_DIR)
+def search(api, hashtag, since_id=None, max_id=None):
+    '''
+    Pages through the search results for a hashtag, newest first, yielding the
+    raw JSON of each tweet. Retweets would lead to data duplication, so those
+    are skipped. Only tweets with since_id < id <= max_id are returned.
+    '''
+    cursor = tweepy.Cursor(
+        api.search, 
+        q=hashtag + GATHER_FILTER,
+        count=100,
+        lang='en',
+        since=datetime.strftime(datetime.now() - timedelta(1), '%Y-%m-%d'),
+        since_id=since_id,
+        max_id=max_id,
+        tweet_mode='extended'
+    )
+    for tweet in cursor.items():
+        yield tweet._json
+
+def new_checkpoint():
+    '''
+    A checkpoint records how far a topic file has been gathered:
+        since_id    every tweet with an id at or below this one has been seen
+        max_id      the highest id seen
+        min_id      the lowest id seen by an unfinished pass, or None
+        rows        the number of rows in the file (the next index)
+        offset      the size of the file in bytes when the checkpoint was made
+    '''
+    return {'since_id': None, 'max_id': None, 'min_id': None, 'rows': 0, 'offset': 0}
+
+def scan_checkpoint(fname):
+    '''
+    Builds a checkpoint for a topic file that doesn't have one, assuming the
+    file came from a gather that finished.
+    '''
+    ckpt = new_checkpoint()
+    with open(fname, 'r', newline='', encoding='utf-8') as src:
+        for row in csv.DictReader(src):
+            ckpt['rows'] += 1
+            if row['id']:
+                ckpt['max_id'] = max(ckpt['max_id'] or 0, int(row['id']))
+    ckpt['since_id'] = ckpt['max_id']
+    ckpt['offset'] = os.path.getsize(fname)
+    return ckpt
+
+def load_checkpoint(proper_name):
+    '''
+    Returns the checkpoint for a topic file, or None if there is no topic file.
+    Checkpoints that don't match their file are rebuilt from the file.
+    '''
+    fname = str(RAW_DIR / (proper_name + '.csv'))
+    if not os.path.exists(fname):
+        return None
+    try:
+        with open(sidecar(RAW_DIR, proper_name, 'ckpt.json'), 'r') as src:
+            ckpt = json.load(src)
+        if ckpt['offset'] <= os.path.getsize(fname):
+            return ckpt
+        log(f'WARN: Checkpoint for {proper_name} is past the end of its file.')
+    except (OSError, ValueError, KeyError):
+        pass
+    return scan_checkpoint(fname)
+
+def save_checkpoint(proper_name, ckpt):
+    # Write to a temporary file first so that an interrupt can't leave a
+    # half-written checkpoint behind.
+    path = sidecar(RAW_DIR, proper_name, 'ckpt.json')
+    with open(str(path) + '.tmp', 'w') as dst:
+        json.dump(ckpt, dst)
+    os.replace(str(path) + '.tmp', path)
+
+def gather_topic(api, trend, search=search, stop=None, append=False):
+    '''
+    Downloads the tweets for a single trending topic into RAW_DIR. Returns the
+    name of the topic file (without extension). If a stop event is given,
+    gathering ends early once it is set.
+
+    If append is set and the topic has been gathered before, only tweets that
+    aren't in the file yet are fetched, and they are added to the end of it.
+    An interrupted gather picks up where its last checkpoint left off.
+    '''
+    hashtag = trend['name']
+    proper_name = '_'.join(hashtag.split(' '))
+    log(f'Gathering tweets for {proper_name}...')
     
-    # Grabs all trending topics with a known tweet volume.
-    topics = []
-    redundant = already_downloaded()
-    for trend in api.trends_place(woeid)[0]['trends']:
-        # Ignore any topics that are empty, those that do not have at least one 
-        # character from the alphabet in their name, or those that we have 
-        # already downloaded.
-        if (
-            re.search('[a-zA-Z]', trend['name']) and
-            trend['name'] not in redundant
-        ):
-            topics.append(trend)
+    # Search for tweets matching the hashtag.
+    total_length = 0
+    total_tweets = 0
+                
+    # Make a file to store the tweets in, or reopen the old one.
+    fname = str(RAW_DIR / (proper_name + '.csv'))
+    ckpt = load_checkpoint(proper_name) if append else None
+    if ckpt:
+        # Rows written after the last checkpoint will be fetched again.
+        with open(fname, 'r+b') as topicfile:
+            topicfile.truncate(ckpt['offset'])
+        log(f'\tResuming {proper_name} from row {ckpt["rows"]}...')
+    else:
+        ckpt = new_checkpoint()
     
-    if len(topics) < 1:
-        log(f'WARN: There are {len(topics)} topics.')
+    with open(fname, 'a' if ckpt['rows'] else 'w+', newline='', encoding='utf-8') as topicfile:
     
-    # Process the first N topics.
-    for trend in topics[:num_topics]:
-        
-        hashtag = trend['name']
-        proper_name = '_'.join(hashtag.split(' '))
-        log(f'Gathering tweets for {proper_name}...')
-        
-        # Search for tweets matching the hashtag.
-        total_length = 0
-        total_tweets = 0
-                    
-        # Make a file to store the tweets in.
-        fname = str(RAW_DIR / (proper_name + '.csv'))
-        with open(fname, 'w+', newline='', encoding='utf-8') as topicfile:
-        
-            # Use a cursor to find tweets and a csv writer to record them.
-            # Retweets would lead to data duplication, so those are skipped.
-            wtr = csv.DictWriter(topicfile, fieldnames=GATHER_FIELDNAMES)
+        # Use a csv writer to record the tweets.
+        wtr = csv.DictWriter(topicfile, fieldnames=GATHER_FIELDNAMES)
+        if not ckpt['rows']:
             wtr.writeheader()
-            cursor = tweepy.Cursor(
-                api.search, 
-                q=hashtag + GATHER_FILTER,
-                count=100,
-                lang='en',
-                since=datetime.strftime(datetime.now() - timedelta(1), '%Y-%m-%d'),
-                tweet_mode='extended'
-            )
-            
-            try:
-                for tweet in cursor.items():
-                    tweet = tweet._json
-                    # Record the body of the tweets and the timestamp.
 
+        def checkpoint():
+            topicfile.flush()
+            ckpt['offset'] = os.fstat(topicfile.fileno()).st_size
+            save_checkpoint(proper_name, ckpt)
+        
+        try:
+            finished = False
+            while not finished:
+                # Finish the pass that was cut short, if there was one, and
+                # then fetch anything newer than what we've seen.
+                resuming = ckpt['min_id'] is not None
+                max_id = ckpt['min_id'] - 1 if resuming else None
+                finished = True
+                for tweet in search(api, hashtag, ckpt['since_id'], max_id):
+                    # Record the body of the tweets and the timestamp.
                     wtr.writerow({
-                        'index': total_tweets, 
+                        'index': ckpt['rows'], 
                         'text': tweet['full_text'],
                         'timestamp': tweet['created_at'], 
                         'fav_count': tweet['favorite_count'], 
@@ -107,15 +181,72 @@ def trending_tweets(api, woeid, num_topics):
                         'id': tweet['id']
                     })
                     
+                    tweet_id = int(tweet['id'])
+                    ckpt['max_id'] = max(ckpt['max_id'] or tweet_id, tweet_id)
+                    ckpt['min_id'] = min(ckpt['min_id'] or tweet_id, tweet_id)
+                    ckpt['rows'] += 1
                     total_length += len(tweet['full_text'])
                     total_tweets += 1
+                    if total_tweets % GATHER_CHECKPOINT_ROWS == 0:
+                        checkpoint()
                     
                     if total_length > GATHER_MAX_CHARS or total_tweets > GATHER_MAX_TWEETS:
-                        log('...Quota met.')
+                        log(f'...Quota met for {proper_name}.')
+                        break
+                    if stop is not None and stop.is_set():
                         break
-            except KeyboardInterrupt:
-                pass
+                else:
+                    # The pass ran to completion, so everything up to the
+                    # newest tweet we've seen is in the file.
+                    ckpt['since_id'] = ckpt['max_id']
+                    ckpt['min_id'] = None
+                    finished = not resuming
+        except KeyboardInterrupt:
+            pass
+        checkpoint()
+
+    log(f'stats for {proper_name}')
+    log(f'\ttotal_length:\t{total_length}')
+    log(f'\ttotal_tweets:\t{total_tweets}')
+    return proper_name
+
+def trending_tweets(api, woeid, num_topics, workers=GATHER_WORKERS, search=search, append=False):
+    
+    # Create the data folder if it doesn't exist.
+    if not os.path.isdir(RAW_DIR):
+        os.mkdir(RAW_DIR)
+    
+    # Grabs all trending topics with a known tweet volume.
+    topics = []
+    redundant = already_downloaded()
+    for trend in api.trends_place(woeid)[0]['trends']:
+        # Ignore any topics that are empty, those that do not have at least one 
+        # character from the alphabet in their name, or those that we have 
+        # already downloaded (unless we're topping them up).
+        if (
+            re.search('[a-zA-Z]', trend['name']) and
+            (append or trend['name'] not in redundant)
+        ):
+            topics.append(trend)
+    
+    if len(topics) < 1:
+        log(f'WARN: There are {len(topics)} topics.')
     
-        log(f'stats for {proper_name}')
-        log(f'\ttotal_length:\t{total_length}')
-        log(f'\ttotal_tweets:\t{total_tweets}')
\ No newline at end of file
+    # Process the first N topics. Gathering is bound by network latency rather
+    # than CPU, so several topics are paged through at once, each on its own
+    # thread and writing to its own file.
+    if workers is None or workers <= 1:
+        return [gather_topic(api, trend, search, append=append) for trend in topics[:num_topics]]
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(gather_topic, api, trend, search, stop, append) for trend in topics[:num_topics]]
+        try:
+            wait(futures)
+        except KeyboardInterrupt:
+            # Worker threads never see crtl+C, so tell them to wrap up and
+            # drop the topics that haven't started yet.
+            log('Stopping early, finishing topics in progress...')
+            stop.set()
+            for future in futures:
+                future.cancel()
+    return [future.result() for future in futures if not future.cancelled()]
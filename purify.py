@@ -5,65 +5,221 @@
 #
 
 # STD LIB
+import io
 import re
 import os
 import csv
 import sys
+import json
 import time
 import string
 import pathlib
+from concurrent.futures import ProcessPoolExecutor
 
 # EXTERNAL LIB
 
 # PROJECT LIB
+import store
+import rowindex
 from extern import *
 
 # CONSTANTS
 TIME_FORMAT = '%H:%M:%S'
 
-def cleanse(target):
-    log(f'Purifying {target}...')
+# Block 1 removes '&amp;' as it is a specific nuisance.
+# Block 2 of this RE removes all usernames.
+# Block 3 removes all punctuation and non-alphanumeric
+#   characters (except apostrophes, @ tags and hashtags).
+# Block 4 removes URLs.
+# NOISE = re.compile('(&amp;)|(@[A-Za-z0-9]+)|([^0-9A-Za-z \t])|(\w+:\/\/\S+)')
+# Currently only using blocks 1, 3, and 4. TODO: Do we want to remove usernames?
+NOISE = re.compile('(&amp;)|([^0-9A-Za-z\'"\.,@# ])|(\w+:\/\/\S+)')
+SPACES = re.compile('(  +)')
+
+def purify(text):
+    text = NOISE.sub(' ', text)
+    # Get rid of excess spaces.
+    return SPACES.sub(' ', text)
+
+def cleanse_chunk(fname, start, end):
+    '''
+    Purifies the rows of a raw file that lie between two byte offsets, which
+    must fall on row boundaries. Returns the purified rows as CSV text along
+    with running totals for the stats: (length_before, length_after,
+    sum of per-tweet reductions, number of tweets).
+    '''
+    with open(fname, 'rb') as src_file:
+        src_file.seek(start)
+        chunk = src_file.read(end - start).decode('utf-8')
 
     length_before = 0
     length_after = 0
-    all_len_diffs = []
+    sum_len_diffs = 0
+    total_tweets = 0
 
-    if not os.path.isdir(DATA_DIR):
-        os.mkdir(DATA_DIR)
+    dst = io.StringIO(newline='')
+    wtr = csv.writer(dst)
+    for row in csv.reader(io.StringIO(chunk, newline='')):
+        text = purify(row[1])
+
+        length_before += len(row[1])
+        length_after += len(text)
+        if row[1]:
+            sum_len_diffs += (len(row[1]) - len(text)) / len(row[1])
+        total_tweets += 1
+
+        row[1] = text
+        wtr.writerow(row)
+
+    return dst.getvalue(), (length_before, length_after, sum_len_diffs, total_tweets)
+
+def _cleanse_chunk(args):
+    return cleanse_chunk(*args)
+
+def load_progress(target, offsets):
+    '''
+    Returns the number of raw rows that have already been purified into
+    DATA_DIR, or None if the data has to be rebuilt from scratch. (0 means a
+    raw file with no rows yet has been purified into just its header.) Progress
+    only counts if neither file has changed since it was recorded, other than
+    rows being added to the end of the raw file.
+    '''
+    fname = str(RAW_DIR / target) + '.csv'
+    dst_fname = str(DATA_DIR / target) + '.csv'
+    try:
+        with open(sidecar(DATA_DIR, target, 'purify.json'), 'r') as src:
+            progress = json.load(src)
+        if (
+            progress['rows'] < len(offsets) and
+            offsets[progress['rows']] == progress['offset'] and
+            fingerprint(fname, progress['offset']) == progress['prefix'] and
+            fingerprint(dst_fname) == progress['data']
+        ):
+            return progress['rows']
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
 
-    with open(str(RAW_DIR / target) + '.csv', 'r', encoding='utf-8') as src_file:
-        with open(str(DATA_DIR / target) + '.csv', 'w', newline='', encoding='utf-8') as dst_file:
-            rdr = csv.reader(src_file)
-            wtr = csv.writer(dst_file)
+def save_progress(target, offsets):
+    fname = str(RAW_DIR / target) + '.csv'
+    with open(sidecar(DATA_DIR, target, 'purify.json'), 'w') as dst:
+        json.dump({
+            'rows': len(offsets) - 1,
+            'offset': int(offsets[-1]),
+            'prefix': fingerprint(fname, int(offsets[-1])),
+            'data': fingerprint(str(DATA_DIR / target) + '.csv'),
+        }, dst)
 
-            for row in rdr:
-                length_before += len(row[1])
+def cleanse(target, workers=PURIFY_WORKERS):
+    '''
+    Purifies RAW_DIR/target.csv into DATA_DIR/target.csv. The raw file is split
+    into chunks of rows which are purified by a pool of worker processes and
+    written back out in their original order.
 
-                # Block 1 removes '&amp;' as it is a specific nuisance.
-                # Block 2 of this RE removes all usernames.
-                # Block 3 removes all punctuation and non-alphanumeric
-                #   characters (except apostrophes, @ tags and hashtags).
-                # Block 4 removes URLs.
-                # text = re.sub('(&amp;)|(@[A-Za-z0-9]+)|([^0-9A-Za-z \t])|(\w+:\/\/\S+)', ' ', row[1])
-                # Currently only using blocks 1, 3, and 4. TODO: Do we want to remove usernames?
-                text = re.sub('(&amp;)|([^0-9A-Za-z\'"\.,@# ])|(\w+:\/\/\S+)', ' ', row[1])
-                # Get rid of excess spaces.
-                text = re.sub('(  +)', ' ', text)
+    Only rows that were added to the raw file since it was last purified are
+    processed; if anything else about it changed, it is purified from scratch.
+    '''
+    if not os.path.isdir(DATA_DIR):
+        os.mkdir(DATA_DIR)
+
+    # The row index tells us where it is safe to split the file.
+    fname = str(RAW_DIR / target) + '.csv'
+    offsets = rowindex.load(RAW_DIR, target)
+    done = load_progress(target, offsets)
+    if done == len(offsets) - 1:
+        log(f'{target} is already purified.')
+        return
+    done = done or 0
+    if done:
+        log(f'Purifying {len(offsets) - 1 - done} new rows of {target}...')
+    else:
+        log(f'Purifying {target}...')
 
-                length_after += len(text)
-                all_len_diffs.append((len(row[1]) - len(text)) / len(row[1]))
+    bounds = list(range(done, len(offsets) - 1, PURIFY_CHUNK_ROWS)) + [len(offsets) - 1]
+    chunks = [(fname, int(offsets[lo]), int(offsets[hi])) for lo, hi in zip(bounds, bounds[1:])]
 
-                row[1] = text
-                wtr.writerow(row)
+    totals = [0, 0, 0, 0]
+    with open(str(DATA_DIR / target) + '.csv', 'a' if done else 'w', newline='', encoding='utf-8') as dst_file:
+        if not done:
+            with open(fname, 'r', newline='', encoding='utf-8') as src_file:
+                csv.writer(dst_file).writerow(next(csv.reader(src_file)))
+        if workers is None or workers <= 1 or len(chunks) <= 1:
+            results = map(_cleanse_chunk, chunks)
+            _write_chunks(dst_file, results, totals)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(_cleanse_chunk, chunks)
+                _write_chunks(dst_file, results, totals)
+    save_progress(target, offsets)
 
-    percent_reduction = round(((length_before - length_after) / length_before) * 100, 3)
-    average_reduction = round((sum(all_len_diffs) / len(all_len_diffs) * 100), 3)
+    length_before, length_after, sum_len_diffs, total_tweets = totals
+    percent_reduction = round(((length_before - length_after) / max(length_before, 1)) * 100, 3)
+    average_reduction = round((sum_len_diffs / max(total_tweets, 1) * 100), 3)
 
     log(f'Stats for {target}:')
-    log(f'\ttotal_tweets:\t\t{len(all_len_diffs)}')
+    log(f'\ttotal_tweets:\t\t{total_tweets}')
     log(f'\tlength_before:\t\t{length_before}')
     log(f'\tlength_after:\t\t{length_after}')
     # Total percentage reduction across the dataset.
     log(f'\tpercent_reduction:\t{percent_reduction}%')
     # Average percentage reduction per tweet.
     log(f'\taverage_reduction:\t{average_reduction}%')
+
+    # Later stages read from the columnar copy of the data where they can.
+    store.build(DATA_DIR, target)
+
+def _write_chunks(dst_file, results, totals):
+    '''Writes purified chunks as they arrive, adding their stats to totals.'''
+    for text, stats in results:
+        dst_file.write(text)
+        for idx, stat in enumerate(stats):
+            totals[idx] += stat
+
+def _test():
+    '''
+    Checks that purifying a raw file while it is still being gathered, and
+    so may end part of the way through a row, gives the same data as
+    purifying the finished file in one go.
+    '''
+    import shutil
+    header = ','.join(GATHER_FIELDNAMES) + '\r\n'
+    rows = [
+        '0,first tweet http://t.co/x,Thu Oct 17 00:00:00 +0000 2019,1,0,a,@a,10\r\n',
+        '1,second tweet is longer,Thu Oct 17 00:00:00 +0000 2019,2,0,b,@b,11\r\n',
+        '2,"third tweet \nspans lines",Thu Oct 17 00:00:00 +0000 2019,3,1,c,@c,12\r\n',
+        '3,fourth tweet &amp; more,Thu Oct 17 00:00:00 +0000 2019,4,1,d,@d,13\r\n',
+    ]
+    whole = header + ''.join(rows)
+    # Cut the file off part of the way through a line, and then inside a
+    # quoted field just past a newline, purifying it each time.
+    start = len(header) + len(rows[0])
+    cuts = [start + rows[1].index(' is'), start + len(rows[1]) + rows[2].index('\n') + 1, len(whole)]
+    try:
+        written = 0
+        for cut in cuts:
+            with open(str(RAW_DIR / '_test-live') + '.csv', 'a', newline='', encoding='utf-8') as dst:
+                dst.write(whole[written:cut])
+            written = cut
+            cleanse('_test-live', 1)
+
+        with open(str(RAW_DIR / '_test-whole') + '.csv', 'w', newline='', encoding='utf-8') as dst:
+            dst.write(whole)
+        cleanse('_test-whole', 1)
+
+        with open(str(DATA_DIR / '_test-live') + '.csv', 'r', encoding='utf-8') as src:
+            live = src.read()
+        with open(str(DATA_DIR / '_test-whole') + '.csv', 'r', encoding='utf-8') as src:
+            finished = src.read()
+        assert live == finished, f'{live!r} != {finished!r}'
+        log('Purifying a file that was still being written matches purifying it whole.')
+    finally:
+        for directory in (RAW_DIR, DATA_DIR):
+            for name in os.listdir(directory):
+                if name.startswith(('_test-live.', '_test-whole.')):
+                    if os.path.isdir(directory / name):
+                        shutil.rmtree(directory / name)
+                    else:
+                        os.remove(directory / name)
+
+if __name__ == '__main__':
+    _test()
@@ -269,7 +269,7 @@ def graph_box(size):
 
     return base
 
-def cluster_box(rep, size, target, conf_color=None):
+def cluster_box(rep, size, target, conf_color=None, population=None):
     width, height = size
 
     cardinality = rep[0]
@@ -290,7 +290,8 @@ def cluster_box(rep, size, target, conf_color=None):
     
     base.paste(tweet_img, tweet_loc)
     
-    proportion = cardinality / len(sample(target))
+    if not population: population = len(sample(target))
+    proportion = cardinality / population
     color = Color(rgb=(conf_color[0] / 255, conf_color[1] / 255, conf_color[2] / 255))
     color.luminance *= 0.66
     color.saturation *= 0.9
@@ -309,7 +310,7 @@ def sent_box(rep, size, target):
     color = sent_color(rep[1])
     return cluster_box(rep, size, target, conf_color=color)
 
-def clustering(size, target, rep0, rep1, rep2, struct, sent=False):
+def clustering(size, target, rep0, rep1, rep2, struct, sent=False, population=None):
     width, height = size
 
     struct_size = (width - SPACING*2, BUFFER*2)
@@ -327,9 +328,9 @@ def clustering(size, target, rep0, rep1, rep2, struct, sent=False):
         cluster_1 = sent_box(rep1, cluster_size, target)
         cluster_2 = sent_box(rep2, cluster_size, target)
     else:
-        cluster_0 = cluster_box(rep0, cluster_size, target)
-        cluster_1 = cluster_box(rep1, cluster_size, target)
-        cluster_2 = cluster_box(rep2, cluster_size, target)
+        cluster_0 = cluster_box(rep0, cluster_size, target, population=population)
+        cluster_1 = cluster_box(rep1, cluster_size, target, population=population)
+        cluster_2 = cluster_box(rep2, cluster_size, target, population=population)
     
     img = Image.new('RGBA', size=size, color=BLANK)
     draw = ImageDraw.Draw(img)
@@ -341,7 +342,7 @@ def clustering(size, target, rep0, rep1, rep2, struct, sent=False):
     
     return img
 
-def create(target, summary, cluster_reps, sent_reps, seed=None, label=None):
+def create(target, summary, cluster_reps, sent_reps, seed=None, label=None, cluster_population=None):
     '''
     Takes data generated by the rest of the program and generates a report.
     '''
@@ -381,7 +382,7 @@ def create(target, summary, cluster_reps, sent_reps, seed=None, label=None):
     summary_img = summary_box(summary, summary_size)
     graph_img = graph_box(graph_size)
     cluster_0_box = clustering(cluster_size, target, cluster_reps[0], cluster_reps[1], cluster_reps[2],
-        'These tweets represent groups who each use the same words.')
+        'These tweets represent groups who each use the same words.', population=cluster_population)
     cluster_1_box = clustering(cluster_size, target, sent_reps[0], sent_reps[1], sent_reps[2],
         'These tweets represent groups who feel strongly on this subject.', sent=True)
     cluster_2_box = clustering(cluster_size, target, sent_reps[3], sent_reps[4], sent_reps[5],
@@ -0,0 +1,112 @@
+#
+# authors:
+#   Paul Galatic
+#
+# description:
+#   Byte-offset index over the rows of a CSV file, for reading individual
+#   rows without parsing the whole file. The index is kept next to the file,
+#   e.g. raw/#Foo.csv is indexed by raw/#Foo.offsets.npz, and is rebuilt
+#   whenever the file changes.
+#
+
+# STD LIB
+import io
+import os
+import csv
+from array import array
+
+# EXTERNAL LIB
+import numpy as np
+
+# PROJECT LIB
+from extern import *
+
+def path(directory, target):
+    return sidecar(directory, target, 'offsets.npz')
+
+def scan(fname, start=0, header=True):
+    '''
+    Returns the byte offset at which each row of a CSV file starts, followed
+    by the offset just past the last complete row. Scanning begins at start,
+    which must be the beginning of a row; if header is set, the first row is
+    taken to be the header and skipped. Quoted fields may contain newlines,
+    so a row only ends at a newline that comes after an even number of quotes.
+    A row with no newline at the end of the file may still be being written,
+    so it is left out; the next scan starts from it.
+    '''
+    offsets = array('q')
+    with open(fname, 'rb') as src:
+        src.seek(start)
+        pos = start
+        quotes = 0
+        for line in src:
+            quotes += line.count(b'"')
+            pos += len(line)
+            if quotes % 2 == 0 and line.endswith(b'\n'):
+                if header:
+                    header = False
+                else:
+                    offsets.append(start)
+                start = pos
+                quotes = 0
+    offsets.append(start)
+    return np.frombuffer(offsets, dtype=np.int64)
+
+def build(directory, target, offsets=None):
+    '''
+    Indexes directory/target.csv and saves the index next to it. If the
+    offsets of an earlier version of the file are given, and the file has
+    only grown since, just the new rows at the end are scanned.
+    '''
+    fname = str(directory / target) + '.csv'
+    if offsets is None:
+        offsets = scan(fname)
+    else:
+        offsets = np.concatenate([offsets[:-1], scan(fname, int(offsets[-1]), header=False)])
+    size = os.path.getsize(fname)
+    np.savez(str(path(directory, target)),
+        offsets=offsets,
+        size=np.array(size),
+        fingerprint=np.array(fingerprint(fname, size)))
+    return offsets
+
+def load(directory, target):
+    '''
+    Returns the row offsets for directory/target.csv, building the index on
+    first use or updating it if the file has changed since it was built.
+    '''
+    fname = str(directory / target) + '.csv'
+    try:
+        with np.load(str(path(directory, target))) as saved:
+            offsets = saved['offsets']
+            size = int(saved['size'])
+            prefix = str(saved['fingerprint'])
+    except (OSError, KeyError, ValueError):
+        return build(directory, target)
+
+    if size > os.path.getsize(fname) or prefix != fingerprint(fname, size):
+        # The file was rewritten, so start over.
+        return build(directory, target)
+    if size < os.path.getsize(fname):
+        # Rows were appended to the file.
+        return build(directory, target, offsets)
+    return offsets
+
+def num_rows(directory, target):
+    return len(load(directory, target)) - 1
+
+def read_rows(directory, target, positions):
+    '''
+    Reads the rows at the given positions (0 being the first row after the
+    header) by seeking straight to them. Rows come back as dictionaries, as
+    they would from csv.DictReader, in the order the positions were given.
+    '''
+    offsets = load(directory, target)
+    rows = []
+    with open(str(directory / target) + '.csv', 'rb') as src:
+        header = next(csv.reader(io.StringIO(src.read(offsets[0]).decode('utf-8'), newline='')))
+        for pos in positions:
+            src.seek(offsets[pos])
+            raw = src.read(offsets[pos + 1] - offsets[pos]).decode('utf-8')
+            rows.append(dict(zip(header, next(csv.reader(io.StringIO(raw, newline=''))))))
+    return rows
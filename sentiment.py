@@ -15,15 +15,23 @@
 
 '''
 import csv
+import math
+import time
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
 from sklearn.cluster import DBSCAN, KMeans
+from sklearn.metrics import silhouette_score
 from os.path import isfile
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 from mpl_toolkits.mplot3d import Axes3D
 from extern import *
+import cache
+import dedup
+import vader
 
 """
 
@@ -37,10 +45,13 @@ from extern import *
     @parameter cluster_method (str) which type of clustering to use, kmeans or dbscan
     @parameter debug (boolean) if debug mode for kmeans clustering mode should be enabled
     @parameter plot_clusters (boolean) if cluster plot should show up
+    @parameter workers (int) how many processes to score tweets and fit KMeans with
+    @parameter scorer (str) 'vader' to score tweets with vaderSentiment, 'vector' to
+        score them in batches with vader.py
 
     @return (object) reps representation for representative tweets
 """
-def find_sentiment_cluster_reps(target, mock, cluster_method='kmeans', debug=False, plot_clusters=False):
+def find_sentiment_cluster_reps(target, mock, cluster_method='kmeans', debug=False, plot_clusters=False, workers=SENTIMENT_WORKERS, scorer=SENTIMENT_SCORER):
     log(f'Performing sentiment analysis on {target}...')
 
     # Uses a subsample of the data as in cluster.py
@@ -54,13 +65,9 @@ def find_sentiment_cluster_reps(target, mock, cluster_method='kmeans', debug=Fal
 
         # Using the actual sentiment analyzer so its not as obvious that the
         # tweet reps are randomly generated
-        analyzer = SentimentIntensityAnalyzer()
-
-        idx = 0
-        for row in subsamp:
-            sentiment = analyzer.polarity_scores(row['text'])
-            reps[idx][1] = sentiment['compound']
-            idx += 1
+        scores = score_tweets([row['text'] for row in subsamp], workers=1, scorer=scorer)
+        for idx in range(len(subsamp)):
+            reps[idx][1] = float(scores[idx, 0])
 
         # Mock cluster sizes so they appear reasonable.
         reps[0][0] = np.random.randint(SAMPLE_SIZE / 5, SAMPLE_SIZE / 3)
@@ -82,15 +89,20 @@ def find_sentiment_cluster_reps(target, mock, cluster_method='kmeans', debug=Fal
         return reps
 
 
+    # Copies of the same tweet all get the same scores, so each distinct text
+    # is only scored once and counts as many times as it was tweeted. Only
+    # exact copies are collapsed, as vader reads case and punctuation
+    t_sample, weights, _ = dedup.collapse(t_sample, exact=True)
+
     # Converts tweets sample to dataframe of tweets with sentiment values
-    sentiment_df = get_sentiment_data_frame(t_sample)
+    sentiment_df = get_sentiment_data_frame(t_sample, weights, workers, scorer)
 
     # Just do one type of clustering, passed in as optional command line arg
     clustering = None
     if cluster_method == 'kmeans':
-        clustering = run_k_means(sentiment_df[['pos', 'neg', 'neu']].values, debug)
+        clustering = run_k_means(sentiment_df[['pos', 'neg', 'neu']].values, debug, weights, workers=workers)
     else:
-        clustering = run_dbscan(sentiment_df[['pos', 'neg', 'neu']].values)
+        clustering = run_dbscan(sentiment_df[['pos', 'neg', 'neu']].values, weights)
 
     sentiment_df['cluster_label'] = clustering.labels_
     if plot_clusters:
@@ -107,6 +119,96 @@ def find_sentiment_cluster_reps(target, mock, cluster_method='kmeans', debug=Fal
     # Returning reps representation from cluster.py
     return convert_to_reps(t_sample, [extreme_clusters, largest_clusters])
 
+# Each worker process builds its own analyzer, once
+_ANALYZER = None
+
+def _init_analyzer():
+    global _ANALYZER
+    _ANALYZER = SentimentIntensityAnalyzer()
+
+'''
+    Scores a chunk of tweets with vader, in whichever process it runs in.
+
+    @param texts (list) tweet texts
+    @returns (array) float32 array of compound, pos, neg, neu for each tweet
+'''
+def score_chunk(texts):
+    if _ANALYZER is None:
+        _init_analyzer()
+
+    scores = np.empty((len(texts), 4), dtype=np.float32)
+    for idx, text in enumerate(texts):
+        tweet_sentiment = _ANALYZER.polarity_scores(text)
+        scores[idx] = (tweet_sentiment['compound'], tweet_sentiment['pos'], tweet_sentiment['neg'], tweet_sentiment['neu'])
+    return scores
+
+'''
+    Scores tweets with vader. Vader is pure Python, so to use more than one
+    core the tweets are split into a chunk per worker (of at least
+    SENTIMENT_MIN_CHUNK_ROWS and at most SENTIMENT_CHUNK_ROWS tweets) and
+    scored by a pool of worker processes. Scores come back in the same order
+    as the tweets.
+
+    @param texts (list) tweet texts
+    @param workers (int) how many processes to score with
+    @param scorer (str) 'vader' or 'vector', see find_sentiment_cluster_reps
+    @returns (array) float32 array of compound, pos, neg, neu for each tweet
+'''
+def _score_pool(texts, workers, scorer=SENTIMENT_SCORER):
+    if scorer == 'vector':
+        # Already scores a chunk at a time, without the per-tweet overhead
+        # that makes the pool worthwhile.
+        return vader.score(texts)
+    size = math.ceil(len(texts) / max(workers or 1, 1))
+    size = min(max(size, SENTIMENT_MIN_CHUNK_ROWS), SENTIMENT_CHUNK_ROWS)
+    chunks = [texts[idx:idx + size] for idx in range(0, len(texts), size)]
+    if workers is None or workers <= 1 or len(chunks) <= 1:
+        results = [score_chunk(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_analyzer) as executor:
+            results = list(executor.map(score_chunk, chunks))
+    return np.concatenate(results) if results else np.empty((0, 4), dtype=np.float32)
+
+_SCORE_TABLES = {}
+
+'''
+    Scores tweets with vader, like _score_pool, but if SENTIMENT_CACHE is set
+    the scores are also kept in a 'sentiment-<scorer>' table in CACHE_DIR,
+    keyed by a hash of the text. Only tweets that have never been scored
+    before, in any run or topic, are scored. (The hash is of the raw text, as
+    vader reads capitalization and punctuation.)
+
+    @param texts (list) tweet texts
+    @param workers (int) how many processes to score with
+    @param scorer (str) 'vader' or 'vector', see find_sentiment_cluster_reps
+    @returns (array) float32 array of compound, pos, neg, neu for each tweet
+'''
+def score_tweets(texts, workers=SENTIMENT_WORKERS, scorer=SENTIMENT_SCORER):
+    if not SENTIMENT_CACHE:
+        return _score_pool(texts, workers, scorer)
+
+    if scorer not in _SCORE_TABLES:
+        _SCORE_TABLES[scorer] = cache.Table(f'sentiment-{scorer}')
+    table = _SCORE_TABLES[scorer]
+
+    keys = [hashlib.sha1(text.encode('utf-8')).hexdigest() for text in texts]
+    found = table.get_many(keys)
+    missing = {}
+    for text, key in zip(texts, keys):
+        if key not in found:
+            missing.setdefault(key, text)
+    if missing:
+        log(f'\tScoring {len(missing)} new tweets...')
+        new_scores = _score_pool(list(missing.values()), workers, scorer)
+        for key, row in zip(missing, new_scores):
+            found[key] = row.tolist()
+        table.put_many({key: found[key] for key in missing})
+
+    scores = np.empty((len(texts), 4), dtype=np.float32)
+    for idx, key in enumerate(keys):
+        scores[idx] = found[key]
+    return scores
+
 '''
     Calculates the sentiment values using the vader library for
     each tweet and stores it in a pandas dataframe for analysis
@@ -116,84 +218,149 @@ def find_sentiment_cluster_reps(target, mock, cluster_method='kmeans', debug=Fal
     pos - the amount of the tweet that has positive sentiment [0, 1]
     neg - the amount of the tweet that has negative sentiment [0, 1]
     neu - the amount of the tweet that has neutral sentiment [0, 1]
+    weight - the number of tweets the row stands for
 
     @param t_sample (list) subsample of tweets
+    @param weights (array) optional number of copies of each tweet
+    @param workers (int) how many processes to score with
+    @param scorer (str) 'vader' or 'vector', see find_sentiment_cluster_reps
     @returns (Dataframe) pandas dataframe of tweets and sentiment values
 '''
-def get_sentiment_data_frame(t_sample):
+def get_sentiment_data_frame(t_sample, weights=None, workers=SENTIMENT_WORKERS, scorer=SENTIMENT_SCORER):
     tweets = [row['text'] for row in t_sample]
+    scores = score_tweets(tweets, workers, scorer)
 
     tweets_map = {
-        'tweet_idx': [],
-        'compound': [],
-        'pos': [],
-        'neg': [],
-        'neu': []
+        'tweet_idx': np.arange(len(tweets)),
+        'compound': scores[:, 0],
+        'pos': scores[:, 1],
+        'neg': scores[:, 2],
+        'neu': scores[:, 3],
+        'weight': np.ones(len(tweets), dtype=np.int64) if weights is None else weights
     }
+    
+    return pd.DataFrame(data=tweets_map)
+
+'''
+    Fits KMeans with k clusters and times the fit. Kept at module level so
+    that worker processes can run it.
 
-    # Sentiment analysis object from Vader
-    analyzer = SentimentIntensityAnalyzer()
+    @param args (tuple) k, the sentiment values and the weights of the tweets
+    @returns (tuple) k, the fitted model and the seconds the fit took
+'''
+def _fit_k(args):
+    k, points, weights = args
+    start = time.time()
+    model = KMeans(n_clusters=k, random_state=1).fit(points, sample_weight=weights)
+    return k, model, time.time() - start
 
-    count = 0
-    for tweet in tweets:
-        tweet_sentiment = analyzer.polarity_scores(tweet)
-        tweets_map['compound'].append(tweet_sentiment['compound'])
-        tweets_map['pos'].append(tweet_sentiment['pos'])
-        tweets_map['neg'].append(tweet_sentiment['neg'])
-        tweets_map['neu'].append(tweet_sentiment['neu'])
+'''
+    Finds the elbow of an inertia curve: the k that lies furthest below the
+    straight line from the first inertia to the last, once both axes are
+    scaled to [0, 1].
 
-        tweets_map['tweet_idx'].append(count)
-        count += 1
-    
-    return pd.DataFrame(data=tweets_map)
+    @param ks (list) the values of k, in increasing order
+    @param inertias (list) the inertia of the model for each k
+    @returns (int) the index of the best k
+'''
+def _elbow(ks, inertias):
+    if len(ks) < 3:
+        return 0
+    ks = np.asarray(ks, dtype=float)
+    inertias = np.asarray(inertias, dtype=float)
+    x = (ks - ks[0]) / (ks[-1] - ks[0])
+    y = (inertias - inertias[-1]) / ((inertias[0] - inertias[-1]) or 1)
+    return int(np.argmax((1 - x) - y))
 
 '''
-    Helper method that will run KMeans on the twitter dataframe.
+    Scores each model by the silhouette of a sample of SILHOUETTE_SAMPLE
+    tweets. The sample is drawn in proportion to the weights, so a tweet
+    counts as often as it was tweeted, and is the same for every model.
+
+    @param points (array) the sentiment values of the tweets
+    @param models (list) fitted KMeans models
+    @param weights (array) optional number of copies of each tweet
+    @returns (list) the silhouette of each model, -1 where it has one cluster
+'''
+def _silhouettes(points, models, weights=None):
+    rng = np.random.RandomState(1)
+    size = min(SILHOUETTE_SAMPLE, len(points))
+    if weights is None:
+        idx = rng.choice(len(points), size, replace=False)
+    else:
+        idx = rng.choice(len(points), size, p=weights / weights.sum())
+    scores = []
+    for model in models:
+        labels = model.labels_[idx]
+        scores.append(silhouette_score(points[idx], labels) if len(np.unique(labels)) > 1 else -1)
+    return scores
 
-    To choose best number of clusters, this method should be run with
-    debug set to true so that the SSE plot is shown. The BEST_K_IDX
-    global parameter can be adjusted to show the clusters for a given
-    'k', where
+'''
+    Helper method that will run KMeans on the twitter dataframe.
 
-    idx     0 1 2 3 ...
-    k       3 4 5 6 ...
+    With K_SELECTION set to 'fixed', DEFAULT_NUM_CLUSTERS clusters are used.
+    Otherwise KMeans is fit for every k from K_START up to K_END, the fits
+    shared among worker processes, and the best k is chosen either at the
+    elbow of the inertia curve ('elbow') or by the silhouette of a sample of
+    the tweets ('silhouette'). Debug mode always chooses k, by the elbow
+    unless K_SELECTION says otherwise, and plots the SSE of each k.
 
     @param tweets_df (Dataframe) dataframe of tweets and sentiment scores
     @param debug (boolean) flag for printing out kmeans information
+    @param weights (array) optional number of copies of each tweet
+    @param selection (str) 'fixed', 'elbow' or 'silhouette'
+    @param workers (int) how many processes to fit with
+    @returns (KMeans) the fitted model with the chosen number of clusters
 '''
-def run_k_means(tweets_df, debug):
-
-    sse = []
-    clusters = []
+def run_k_means(tweets_df, debug, weights=None, selection=K_SELECTION, workers=SENTIMENT_WORKERS):
+    if selection == 'fixed' and not debug:
+        return KMeans(n_clusters=DEFAULT_NUM_CLUSTERS, random_state=1).fit(tweets_df, sample_weight=weights)
+
+    start = time.time()
+    jobs = [(k, tweets_df, weights) for k in range(K_START, K_END)]
+    if workers is None or workers <= 1:
+        fits = [_fit_k(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+            fits = list(executor.map(_fit_k, jobs))
+    fit_time = time.time() - start
+
+    ks = [k for k, _, _ in fits]
+    clusters = [model for _, model, _ in fits]
+    sse = [model.inertia_ for model in clusters]
+
+    start = time.time()
+    if selection == 'silhouette':
+        scores = _silhouettes(tweets_df, clusters, weights)
+        best = int(np.argmax(scores))
+    else:
+        scores = sse
+        best = _elbow(ks, sse)
+    score_time = time.time() - start
 
     if debug:
-        for k in range(K_START, K_END):
-            kmeans_result = KMeans(n_clusters=k, random_state=1).fit(tweets_df)
-            clusters.append(kmeans_result)
+        for k, inertia, score, (_, _, seconds) in zip(ks, sse, scores, fits):
+            log(f'k = {k}, sse = {inertia}, score = {score}, fit in {seconds:.2f}s')
 
-            sse.append(kmeans_result.inertia_)
-            log(f'k = {k}, sse = {kmeans_result.inertia_}')
-        
         plt.figure()
         plt.plot(np.arange(K_START, K_END), sse)
         plt.xlabel('Number of clusters')
         plt.ylabel('Sum of Squared Errors')
         plt.show()
-        
-        # TODO: Which cluster is actually the best?
-        clusters[BEST_K_IDX]
-    
-    else:
-        return KMeans(n_clusters=DEFAULT_NUM_CLUSTERS, random_state=1).fit(tweets_df)
+
+    log(f'\tChose k = {ks[best]} of {ks[0]}-{ks[-1]}: fitting took {fit_time:.2f}s '
+        f'({sum(seconds for _, _, seconds in fits):.2f}s of fits), scoring {score_time:.2f}s')
+    return clusters[best]
 
 '''
     Runs the DBSCAN algorithm. Separate function for consistency
     and to support additional operations later on.
 
     @param tweets_df (Dataframe) dataframe of tweets and sentiment scores
+    @param weights (array) optional number of copies of each tweet
 '''
-def run_dbscan(tweets_df):
-    return DBSCAN(eps=0.015, min_samples=10).fit(tweets_df)
+def run_dbscan(tweets_df, weights=None):
+    return DBSCAN(eps=0.015, min_samples=10).fit(tweets_df, sample_weight=weights)
 
 '''
     Helper function that will plot the clustering results
@@ -236,64 +403,49 @@ def plot_clustering_results(tweets_df, num_clusters, plot_title="Clustering of S
     @returns (Pandas dataframe) cluster info dataframe
 """
 def get_cluster_centers_info(tweets_df, clusters):
+    clusters = np.asarray(clusters, dtype=np.int64)
+    labels = tweets_df['cluster_label'].values
+    # DBSCAN labels noise -1, which belongs to no cluster
+    members = labels >= 0
+    labels = labels[members]
+    weight = tweets_df['weight'].values[members]
+    scores = tweets_df[['compound', 'pos', 'neg', 'neu']].values[members]
+    tweet_idx = tweets_df['tweet_idx'].values[members]
+    num_clusters = max(int(clusters.max()) + 1 if len(clusters) else 0, int(labels.max()) + 1 if len(labels) else 0)
 
     # Determines what the cluster centers should be
-    # Defined as the averages for pos, neg, and neu for all the points in the cluster
-    cluster_centers = []
-    for cluster in range(len(clusters)):
-        cluster_df = tweets_df[tweets_df['cluster_label'] == cluster]
-        cluster_size = len(cluster_df)
-
-        compound = cluster_df[['compound']].values
-        pos = cluster_df[['pos']].values
-        neg = cluster_df[['neg']].values
-        neu = cluster_df[['neu']].values
-
-        cluster_centers.append((compound.sum() / cluster_size, pos.sum() / cluster_size, neg.sum() / cluster_size, neu.sum() / cluster_size))
+    # Defined as the averages for pos, neg, and neu for all the points in the cluster,
+    # where each point counts once for every copy of its tweet
+    cluster_size = np.bincount(labels, weights=weight, minlength=num_clusters)
+    cluster_centers = np.stack([np.bincount(labels, weights=weight * scores[:, col], minlength=num_clusters)
+        for col in range(4)], axis=1) / cluster_size[:, None]
+
+    # The center tweet of each cluster is the one nearest its center, or the
+    # first of those if several are as near
+    dist = np.linalg.norm(scores[:, 1:] - cluster_centers[labels, 1:], axis=1)
+    min_dist = np.full(num_clusters, np.inf)
+    np.minimum.at(min_dist, labels, dist)
+    nearest = np.flatnonzero(dist == min_dist[labels])
+    found, first = np.unique(labels[nearest], return_index=True)
+    center = np.zeros(num_clusters, dtype=np.int64)
+    center[found] = nearest[first]
+    center = center[clusters]
 
     # Creating a separate dataframe to keep track of cluster stats
     cluster_info_df = {
-        'overall_compound': [],
-        'overall_pos': [],
-        'overall_neg': [],
-        'overall_neu': [],
-        'center_tweet_id': [],
-        'center_compound': [],
-        'center_pos': [],
-        'center_neg': [],
-        'center_neu': [],
-        'cluster_size': [],
-        'cluster_label': []
+        'overall_compound': cluster_centers[clusters, 0],
+        'overall_pos': cluster_centers[clusters, 1],
+        'overall_neg': cluster_centers[clusters, 2],
+        'overall_neu': cluster_centers[clusters, 3],
+        'center_tweet_id': tweet_idx[center],
+        'center_compound': scores[center, 0],
+        'center_pos': scores[center, 1],
+        'center_neg': scores[center, 2],
+        'center_neu': scores[center, 3],
+        'cluster_size': cluster_size[clusters].astype(np.int64),
+        'cluster_label': clusters
     }
 
-    for cluster in clusters:
-        
-        centroid = cluster_centers[cluster]
-        cluster_points = tweets_df[tweets_df['cluster_label'] == cluster]
-
-        min_distance = float('inf')
-        center_point = None
-        for _, row in cluster_points.iterrows():
-            point = row[['pos', 'neg', 'neu']].values
-            point_dist = np.linalg.norm((point-centroid[1:]))
-            if point_dist < min_distance:
-                min_distance = point_dist
-                center_point = row
-
-        cluster_info_df['overall_compound'].append(centroid[0])
-        cluster_info_df['overall_pos'].append(centroid[1])
-        cluster_info_df['overall_neg'].append(centroid[2])
-        cluster_info_df['overall_neu'].append(centroid[3])
-
-        cluster_info_df['center_tweet_id'].append(center_point['tweet_idx'])
-        cluster_info_df['center_compound'].append(center_point['compound'])
-        cluster_info_df['center_pos'].append(center_point['pos'])
-        cluster_info_df['center_neg'].append(center_point['neg'])
-        cluster_info_df['center_neu'].append(center_point['neu'])
-
-        cluster_info_df['cluster_label'].append(cluster)
-        cluster_info_df['cluster_size'].append(len(cluster_points))
-    
     return pd.DataFrame(data=cluster_info_df)
 
 """
@@ -347,11 +499,8 @@ def get_k_largest_clusters(cluster_info_df, excluded_clusters, k=MAX_PRINTED_CLU
 def convert_to_reps(t_sample, cluster_dfs):
     reps = []
     for cluster_df in cluster_dfs:
-        for _, cluster in cluster_df.iterrows():
-            cluster_rep = []
-            cluster_rep.append(int(cluster['cluster_size']))
-            cluster_rep.append(cluster['center_compound'])
-            cluster_rep.append(t_sample[int(cluster['center_tweet_id'])])
-            reps.append(cluster_rep)
+        for size, compound, tweet_id in zip(cluster_df['cluster_size'].values.tolist(),
+                cluster_df['center_compound'].values.tolist(), cluster_df['center_tweet_id'].values.tolist()):
+            reps.append([int(size), compound, t_sample[int(tweet_id)]])
     
     return reps
\ No newline at end of file
@@ -0,0 +1,266 @@
+#
+# authors:
+#   Paul Galatic
+#
+# description:
+#   Columnar storage for datasets in the GATHER_FIELDNAMES format. Each column
+#   is kept in its own file inside a sidecar directory next to the CSV, e.g.
+#
+#   data/
+#       #Foo.csv
+#       #Foo.cols/
+#           meta.json
+#           index.npy, timestamp.npy, fav_count.npy, ret_count.npy, id.npy
+#           text.heap, text.offsets.npy (and the same for username, at_tag)
+#           fav_count.order.npy, ret_count.order.npy
+#
+#   Numeric columns are int64 arrays (-1 where the CSV was blank). Strings are
+#   UTF-8 bytes laid end to end in a heap, with an array of offsets marking
+#   where each one starts. The engagement columns also have an ordering: the
+#   positions of the rows, most liked (or retweeted) first. Every file can be
+#   memory-mapped, so loading a store only touches the columns (and rows) that
+#   are actually used.
+#
+
+# STD LIB
+import io
+import os
+import csv
+import json
+import mmap
+import shutil
+from array import array
+from datetime import datetime, timezone
+
+# EXTERNAL LIB
+import numpy as np
+
+# PROJECT LIB
+from extern import *
+
+# CONSTANTS
+NUMERIC_COLUMNS = ['index', 'timestamp', 'fav_count', 'ret_count', 'id']
+STRING_COLUMNS = ['text', 'username', 'at_tag']
+ENGAGEMENT_COLUMNS = ['fav_count', 'ret_count']
+MISSING = -1
+
+class StringColumn:
+    '''A read-only sequence of strings backed by a heap and an offset array.'''
+    def __init__(self, heap_path, offsets_path):
+        self.offsets = np.load(str(offsets_path), mmap_mode='r')
+        with open(heap_path, 'rb') as heap:
+            if os.fstat(heap.fileno()).st_size > 0:
+                self.heap = mmap.mmap(heap.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.heap = b''
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.heap[self.offsets[idx]:self.offsets[idx + 1]].decode('utf-8')
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+def path(directory, target):
+    return sidecar(directory, target, 'cols')
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return MISSING
+
+def _to_epoch(value):
+    try:
+        return int(datetime.strptime(value, TIME_FORMAT).timestamp())
+    except (TypeError, ValueError):
+        return MISSING
+
+def _from_epoch(value):
+    if value == MISSING:
+        return ''
+    return datetime.fromtimestamp(int(value), timezone.utc).strftime(TIME_FORMAT)
+
+def _read_meta(directory, target):
+    try:
+        with open(path(directory, target) / 'meta.json', 'r') as meta:
+            return json.load(meta)
+    except (OSError, ValueError):
+        return None
+
+def build(directory, target):
+    '''
+    Converts directory/target.csv into a columnar store. If the CSV has only
+    had rows added to it since the store was last built, just those rows are
+    converted and added to the end of each column; otherwise the store is
+    rebuilt from scratch.
+    '''
+    src_path = str(directory / target) + '.csv'
+    root = path(directory, target)
+    meta = _read_meta(directory, target)
+    if (
+        meta and
+        meta['source_size'] <= os.path.getsize(src_path) and
+        meta.get('source_prefix') == fingerprint(src_path, meta['source_size'])
+    ):
+        if meta['source_size'] < os.path.getsize(src_path):
+            _convert(src_path, root, meta['source_size'])
+        elif meta['source_mtime'] != os.stat(src_path).st_mtime:
+            # Same contents with a new timestamp, e.g. touched or rewritten
+            # unchanged, so only the metadata needs updating.
+            _write_meta(root, src_path)
+        return root
+
+    tmp = pathlib.Path(str(root) + '.tmp')
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.mkdir(tmp)
+    _convert(src_path, tmp)
+    if os.path.isdir(root):
+        shutil.rmtree(root)
+    os.replace(tmp, root)
+    return root
+
+def _convert(src_path, root, start=None):
+    '''
+    Converts the rows of a CSV file into columns inside root. If start is
+    given, it is the byte offset just past the rows already in root, and the
+    rows from there on are added to the existing columns.
+    '''
+    numbers = {col: array('q') for col in NUMERIC_COLUMNS}
+    offsets = {col: array('q', [0]) for col in STRING_COLUMNS}
+    if start is not None:
+        # Drop anything an interrupted update left past the last offset
+        # before adding to the heaps.
+        for col in STRING_COLUMNS:
+            end = int(np.load(str(root / f'{col}.offsets.npy'), mmap_mode='r')[-1])
+            with open(root / f'{col}.heap', 'r+b') as heap:
+                heap.truncate(end)
+            offsets[col][0] = end
+
+    with open(src_path, 'r', newline='', encoding='utf-8') as src:
+        header = next(csv.reader(src))
+
+    heaps = {col: open(root / f'{col}.heap', 'ab') for col in STRING_COLUMNS}
+    try:
+        with open(src_path, 'rb') as raw_src:
+            rdr = csv.reader(io.TextIOWrapper(raw_src, encoding='utf-8', newline=''))
+            if start is None:
+                next(rdr)
+            else:
+                raw_src.seek(start)
+            for values in rdr:
+                row = dict(zip(header, values))
+                for col in NUMERIC_COLUMNS:
+                    if col == 'timestamp':
+                        numbers[col].append(_to_epoch(row.get(col)))
+                    else:
+                        numbers[col].append(_to_int(row.get(col)))
+                for col in STRING_COLUMNS:
+                    encoded = (row.get(col) or '').encode('utf-8')
+                    heaps[col].write(encoded)
+                    offsets[col].append(offsets[col][-1] + len(encoded))
+    finally:
+        for heap in heaps.values():
+            heap.close()
+
+    for col in NUMERIC_COLUMNS:
+        column = np.frombuffer(numbers[col], dtype=np.int64)
+        if start is not None:
+            column = np.concatenate([np.load(str(root / f'{col}.npy')), column])
+        np.save(str(root / f'{col}.npy'), column)
+    for col in STRING_COLUMNS:
+        column = np.frombuffer(offsets[col], dtype=np.int64)
+        if start is not None:
+            column = np.concatenate([np.load(str(root / f'{col}.offsets.npy'))[:-1], column])
+        np.save(str(root / f'{col}.offsets.npy'), column)
+    for col in ENGAGEMENT_COLUMNS:
+        _rank(root, col)
+
+    # The metadata is written last, so an interrupted update is redone.
+    _write_meta(root, src_path)
+
+def _write_meta(root, src_path):
+    stat = os.stat(src_path)
+    with open(root / 'meta.json', 'w') as meta:
+        json.dump({
+            'rows': len(np.load(str(root / 'index.npy'), mmap_mode='r')),
+            'source_size': stat.st_size,
+            'source_mtime': stat.st_mtime,
+            'source_prefix': fingerprint(src_path),
+        }, meta)
+
+def _rank(root, col):
+    # Ties stay in row order.
+    order = np.argsort(-np.load(str(root / f'{col}.npy')), kind='stable')
+    np.save(str(root / f'{col}.order.npy'), order)
+    return order
+
+def ranking(directory, target, col):
+    '''
+    Returns the positions of the rows sorted by an engagement column, most
+    first, as a memory-mapped array.
+    '''
+    root = path(directory, target)
+    try:
+        return np.load(str(root / f'{col}.order.npy'), mmap_mode='r')
+    except OSError:
+        # The store was built before it kept orderings.
+        return _rank(root, col)
+
+def is_fresh(directory, target):
+    '''
+    True if the store exists and was built from the current CSV. A CSV with
+    the same size but a new timestamp is compared by fingerprint, the same
+    way build() compares it.
+    '''
+    src_path = str(directory / target) + '.csv'
+    meta = _read_meta(directory, target)
+    try:
+        stat = os.stat(src_path)
+    except OSError:
+        return False
+    if not meta or meta['source_size'] != stat.st_size:
+        return False
+    return meta['source_mtime'] == stat.st_mtime or meta.get('source_prefix') == fingerprint(src_path)
+
+def load(directory, target, columns=None):
+    '''
+    Returns a dictionary of the requested columns (all of them by default).
+    Numeric columns are memory-mapped arrays and string columns are
+    StringColumns, so nothing is read from disk until it is indexed.
+    '''
+    root = path(directory, target)
+    if columns is None:
+        columns = GATHER_FIELDNAMES
+    loaded = {}
+    for col in columns:
+        if col in NUMERIC_COLUMNS:
+            loaded[col] = np.load(str(root / f'{col}.npy'), mmap_mode='r')
+        else:
+            loaded[col] = StringColumn(root / f'{col}.heap', root / f'{col}.offsets.npy')
+    return loaded
+
+def num_rows(columns):
+    return len(next(iter(columns.values())))
+
+def to_rows(columns, positions):
+    '''
+    Gathers the rows at the given positions back into dictionaries with the
+    same string values csv.DictReader would have produced.
+    '''
+    rows = []
+    for pos in positions:
+        row = {}
+        for col, values in columns.items():
+            if col == 'timestamp':
+                row[col] = _from_epoch(values[pos])
+            elif col in NUMERIC_COLUMNS:
+                row[col] = '' if values[pos] == MISSING else str(values[pos])
+            else:
+                row[col] = values[pos]
+        rows.append(row)
+    return rows
@@ -6,22 +6,40 @@
 #       NOTE: Might need to run 'python3 -m spacy download en' to download english spacy package
 
 import re
+import csv
+import heapq
+import hashlib
+import functools
+import itertools
+from array import array
+import numpy as np
+from scipy import sparse
 import spacy
+from spacy.tokens import Doc
 from spacy.lang.en.stop_words import STOP_WORDS
 import wikipedia
 import random as r
-from heapq import nlargest
 from collections import Counter
 from string import punctuation
 from extern import *
+import cache
+import dedup
+import store
 r.seed(Q_RANDOM_SEED)
 
+# What to leave out of cached docs. spaCy 2.1 and later take a list of fields
+# to exclude, while 2.0 takes each field as a keyword (and ignores its value).
+if tuple(int(part) for part in spacy.__version__.split('.')[:2]) < (2, 1):
+    DOC_EXCLUDE = {field: False for field in DOC_CACHE_EXCLUDE}
+else:
+    DOC_EXCLUDE = {'exclude': DOC_CACHE_EXCLUDE}
+
 # Function to test the functionality of text_summarization.py
 def _test():
     wikipedia.set_lang('en')
     document_1 = str(wikipedia.page(TEST_WIKI_ARTICLE).content)
 
-    final_summary = core_summary_function(document_1)
+    final_summary = core_summary_function(document_1.split('\n'), '#' + TEST_WIKI_ARTICLE)
     print(final_summary)
 
 def _is_repeat_sentence(s):
@@ -37,18 +55,48 @@ def _is_repeat_sentence(s):
     return False
 
 # encapsulates logic that is repeated for num_likes and num_retweets
-def _get_top_tweets_helper(top_arr, num_for_metric, metric):
+def _pick_top(order, num_positive, num_for_metric):
+    '''
+    Given positions of tweets sorted by a metric, most first, and how many of
+    them have a count above 0, returns the positions of the top tweets for
+    the metric. If too few tweets have been liked (or retweeted), the rest
+    are picked at random from those that haven't.
+    '''
+    top_n_arr = list(order[:min(num_for_metric, num_positive)])
+    num_randomly_sampled_zero_metric_tweets = min(num_for_metric - len(top_n_arr), len(order) - num_positive)
+    if num_randomly_sampled_zero_metric_tweets > 0:
+        zero_idxs = r.sample(range(num_positive, len(order)), num_randomly_sampled_zero_metric_tweets)
+        top_n_arr.extend(order[zero_idxs])
+    return top_n_arr
+
+def _pick_distinct(texts, order, num_positive, num_for_metric):
+    '''
+    Same as _pick_top, but copies of a tweet (texts that are the same once
+    normalized, as dedup.collapse has it) only count once, so they can't crowd
+    each other out of the top tweets. The ranking is read a block at a time
+    until enough distinct tweets are found, keeping the first copy of each.
+    '''
+    seen = set()
     top_n_arr = []
-    for i, t in enumerate(top_arr):
-        if int(t[metric] if t[metric] else 0) > 0:
-            top_n_arr.append(t)
-        else:
-            zero_idx = i
+
+    def keep(positions):
+        for pos in positions:
+            if len(top_n_arr) == num_for_metric:
+                return
+            key = dedup.normalize(texts[pos])
+            if key not in seen:
+                seen.add(key)
+                top_n_arr.append(pos)
+
+    block = max(2 * num_for_metric, 1)
+    for start in range(0, num_positive, block):
+        if len(top_n_arr) == num_for_metric:
             break
-    zero_occ_for_metric = top_arr[zero_idx:]
-    r.shuffle(zero_occ_for_metric)
-    num_randomly_sampled_zero_metric_tweets = num_for_metric - len(top_n_arr)
-    top_n_arr.extend(zero_occ_for_metric[:num_randomly_sampled_zero_metric_tweets])
+        keep(np.asarray(order[start:min(start + block, num_positive)]).tolist())
+    num_randomly_sampled_zero_metric_tweets = min(num_for_metric - len(top_n_arr), len(order) - num_positive)
+    if num_randomly_sampled_zero_metric_tweets > 0:
+        zero_idxs = r.sample(range(num_positive, len(order)), num_randomly_sampled_zero_metric_tweets)
+        keep(np.asarray(order)[zero_idxs].tolist())
     return top_n_arr
 
 def _remove_duplicates(tweets):
@@ -62,93 +110,252 @@ def _remove_duplicates(tweets):
     return results
 
 def get_top_tweets(tweets, num_likes=100, num_retweets=100):
-    top_likes = sorted(tweets, key=lambda t: int(t['fav_count'] if t['fav_count'] else 0), reverse=True)
-    _num_likes = r.randint(len(tweets) // 2, len(tweets)) if num_likes > len(tweets) else num_likes
-    top_n_likes = _get_top_tweets_helper(top_likes, _num_likes, 'fav_count')
-
-    top_retweets = sorted(tweets, key=lambda t: int(t['ret_count'] if t['ret_count'] else 0), reverse=True)
-    _num_retweets = r.randint(len(tweets) // 2, len(tweets)) if num_retweets > len(tweets) else num_retweets
-    top_n_retweets = _get_top_tweets_helper(top_retweets, _num_retweets, 'ret_count')
-    
-    combined = [*top_n_likes, *top_n_retweets]
+    combined = []
+    for metric, num in (('fav_count', num_likes), ('ret_count', num_retweets)):
+        counts = np.array([int(t[metric] if t[metric] else 0) for t in tweets], dtype=np.int64)
+        _num = r.randint(len(tweets) // 2, len(tweets)) if num > len(tweets) else num
+        order = np.argsort(-counts, kind='stable')
+        combined.extend(tweets[idx] for idx in _pick_top(order, np.count_nonzero(counts > 0), _num))
     return _remove_duplicates(combined)
 
-def core_summary_function(document, target, lang='en', max_sentence_len=30):
+def top_tweets(target, num_likes=100, num_retweets=100):
+    '''
+    Same as get_top_tweets, but over every tweet of a topic rather than the
+    sample. The tweets are found through the engagement orderings kept in the
+    topic's columnar store, so nothing is sorted and only the chosen rows are
+    read. Copies of a tweet are collapsed, as the sample is in
+    summarize_tweets.
+    '''
+    columns = store.load(DATA_DIR, target)
+    num_tweets = store.num_rows(columns)
+    positions = []
+    for metric, num in (('fav_count', num_likes), ('ret_count', num_retweets)):
+        _num = r.randint(num_tweets // 2, num_tweets) if num > num_tweets else num
+        num_positive = int(np.count_nonzero(np.asarray(columns[metric]) > 0))
+        positions.extend(_pick_distinct(columns['text'], store.ranking(DATA_DIR, target, metric), num_positive, _num))
+    # A tweet can be among the top for both metrics, or be a copy of one that is
+    return list(dedup.collapse(store.to_rows(columns, positions))[0])
+
+@functools.lru_cache(maxsize=None)
+def load_nlp(lang='en'):
+    # Load the pipeline once per process. Only the parser is needed, for
+    # sentence boundaries, so the tagger and NER are left out.
+    return spacy.load(lang, disable=['tagger', 'ner'])
+
+@functools.lru_cache(maxsize=None)
+def doc_table(lang='en'):
+    # Parses depend on the model and on which of its components ran, so each
+    # combination gets a table of its own.
+    nlp = load_nlp(lang)
+    model = f"{nlp.meta['lang']}_{nlp.meta['name']}-{nlp.meta['version']}"
+    return cache.Table(f"docs-{model}-{'+'.join(nlp.pipe_names)}", binary=True)
+
+def _pipe(nlp, texts, n_process):
+    if n_process > 1:
+        # Needs spaCy 2.2 or later.
+        return nlp.pipe(texts, batch_size=SPACY_BATCH_SIZE, n_process=n_process)
+    return nlp.pipe(texts, batch_size=SPACY_BATCH_SIZE)
+
+def parse(texts, lang='en', n_process=SUMMARIZE_PROCESSES, use_cache=SPACY_DOC_CACHE):
+    '''
+    Parses texts in batches, yielding one doc per text, in order. If
+    use_cache is set, parsed docs are saved to CACHE_DIR under a hash of
+    their text, and only texts that haven't been parsed by the same model
+    before are parsed again.
+    '''
+    nlp = load_nlp(lang)
+    if not use_cache:
+        yield from _pipe(nlp, texts, n_process)
+        return
+
+    table = doc_table(lang)
+    texts = iter(texts)
+    while True:
+        chunk = list(itertools.islice(texts, SPACY_CACHE_CHUNK))
+        if not chunk:
+            break
+        keys = [hashlib.sha1(text.encode('utf-8')).hexdigest() for text in chunk]
+        found = table.get_many(keys)
+        parsed = _pipe(nlp, [text for text, key in zip(chunk, keys) if key not in found], n_process)
+        for key in keys:
+            if key in found:
+                yield Doc(nlp.vocab).from_bytes(found[key], **DOC_EXCLUDE)
+            else:
+                doc = next(parsed)
+                table.put(key, doc.to_bytes(**DOC_EXCLUDE))
+                yield doc
+
+def core_summary_function(texts, target, lang='en', max_sentence_len=30):
     _target = target[1:]
-    nlp = spacy.load(lang)
-    # Had to set it to a high value to process large collections of text
-    nlp.max_length = NLP_DOC_LENGTH
-    nlp_doc = nlp(document)
+    # Each text is parsed as its own doc, so there's never one huge doc in memory
+    texts = list(texts)
 
     hashtag_set = set()
-    document_sentences = document.split('\n')
-    for line in document_sentences:
-        for w in line.split(' '):
+    for line in texts:
+        for w in line.split():
             if len(w) > 0 and '#' in w:
                 if w[0] == '#':
                     hashtag_set.add(w[1:])
                 else:
                     hashtag_set.add(w)
 
+    ### Sentence x term matrix
+    # 		one row of word counts per sentence, along with masks of which
+    # 		sentences are worth scoring (the word counts are gathered on the
+    # 		same pass)
+
+    word_counts = Counter()
+    vocab = {}
+    indices = array('i')
+    indptr = array('q', [0])
+    sent_texts = {}
+    long_enough = array('b')
+    short_enough = array('b')
+    not_repeated = array('b')
+    for doc in parse(texts, lang):
+        word_counts.update(word.text.strip(punctuation).lower() for word in doc)
+        for sent in doc.sents:
+            # a sentence seen before gets the same row, so only the first
+            # one matters
+            if sent.text in sent_texts:
+                continue
+            sent_texts[sent.text] = len(sent_texts)
+            long_enough.append(len(sent) > 2)
+            short_enough.append(len(sent.text.split(' ')) < max_sentence_len)
+            not_repeated.append(not _is_repeat_sentence(sent.text))
+            indices.extend(vocab.setdefault(word.text.lower(), len(vocab)) for word in sent if word.text != _target)
+            indptr.append(len(indices))
+
+    sent_texts = list(sent_texts)
+    counts = sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.float32), np.frombuffer(indices, dtype=np.int32), np.frombuffer(indptr, dtype=np.int64)),
+        shape=(len(sent_texts), len(vocab)))
+
+    # ignore sentences that aren't a certain length, that repeat the same
+    # thing over and over, or that are too long
+    eligible = np.frombuffer(long_enough, dtype=bool) & np.frombuffer(not_repeated, dtype=bool)
+    # ignore sentences that are duplicates of an earlier eligible sentence
+    stripped = np.array([text.strip() for text in sent_texts], dtype=object)
+    firsts = np.flatnonzero(eligible)[np.unique(stripped[eligible], return_index=True)[1]] if eligible.any() else []
+    unique = np.zeros(len(sent_texts), dtype=bool)
+    unique[firsts] = True
+    eligible = unique & np.frombuffer(short_enough, dtype=bool)
+
     ### Word frequency table
-    # 		dictionary of words and their counts using non stop words
-
-    word_freq = {}
-    for word in nlp_doc:
-        w = word.text
-        w = w.strip(punctuation)
-        w = w.lower()
-        # stopword omission
-        if w not in STOP_WORDS and w not in hashtag_set:
-            if w not in word_freq:
-                word_freq[w] = 0
-            word_freq[w] += 1
+    # 		normalized frequencies of non stop words, counted from the same
+    # 		spaCy tokens as the sentence x term matrix
+
+    word_freq = {w: count for (w, count) in word_counts.items() if w not in STOP_WORDS and w not in hashtag_set}
 
     ### Maximum frequency
-    max_freq = max(word_freq.items(), key=lambda x: x[1])[1] # recall that the 0th index is the word
+    max_freq = max(word_freq.values())
 
-    for (word, freq) in word_freq.items():
-        word_freq[word] = freq/max_freq
+    freq = np.zeros(len(vocab))
+    for (word, col) in vocab.items():
+        freq[col] = word_freq.get(word, 0) / max_freq
 
     ### Sentence scores
     # 		scoring every sentence based on the number of words
     # 		(non-stop words in our word freq table)
 
-    sentence_list = [sentence for sentence in nlp_doc.sents]
-    seen_sentences = set()
+    scores = counts @ freq
+    # only sentences with at least one word in the table are scored
+    candidates = np.flatnonzero(eligible & (counts @ (freq > 0) > 0))
 
-    sent_scores = {}
-    for sent in sentence_list:
-        # ignore sentences that aren't a certain length
-        if len(sent) <= 2:
-            continue
-        # ignore sentences that repeat the same thing over and over
-        if _is_repeat_sentence(sent):
-            continue
-        # ignore sentences that are duplicates
-        if sent.text.strip() in seen_sentences:
-            continue
-        seen_sentences.add(sent.text.strip())
-        for word in sent:
-            if word.text == _target:
-                continue
-            w = word.text.lower()
-            if w in word_freq:
-                if len(sent.text.split(' ')) < max_sentence_len:
-                    if sent not in sent_scores:
-                        sent_scores[sent] = 0
-                    sent_scores[sent] += word_freq[w]
+    # Take the top sentences, earliest first among equal scores.
+    k = min(NUM_SENTENCE_SUMMARY, len(candidates))
+    if k > 0:
+        kth = scores[candidates][np.argpartition(-scores[candidates], k - 1)[k - 1]]
+        candidates = candidates[scores[candidates] >= kth]
+        candidates = candidates[np.lexsort((candidates, -scores[candidates]))][:k]
+    summarized_sentences = [sent_texts[idx] for idx in candidates[:k]]
 
-    summarized_sentences = nlargest(NUM_SENTENCE_SUMMARY, sent_scores, key=sent_scores.get)
+    return _format_summary(summarized_sentences)
 
+def _format_summary(summarized_sentences):
     # convert spacy span to string
-    final_sentences = [s.text.replace('\n', ' ').replace('.', ' ').strip().capitalize() for s in summarized_sentences]
+    final_sentences = [s.replace('\n', ' ').replace('.', ' ').strip().capitalize() for s in summarized_sentences]
     final_summary = '. '.join(final_sentences) + '.'
     for pattern, replacement in REPLACE_DICT.items():
         final_summary = re.sub(pattern, replacement, final_summary)
 
     return final_summary
 
+class HeavyHitters:
+    '''
+    Counts items in bounded memory. Once more than twice capacity distinct
+    items are being counted, all but the capacity most common are dropped, so
+    frequent items are counted (nearly) exactly while rare ones come and go.
+    With no capacity, every item is counted exactly.
+    '''
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.counts = Counter()
+
+    def update(self, items):
+        self.counts.update(items)
+        if self.capacity and len(self.counts) > 2 * self.capacity:
+            self.counts = Counter(dict(self.counts.most_common(self.capacity)))
+
+def _read_texts(target, hashtags):
+    '''Streams the texts of a topic's purified file, counting hashtags on the way.'''
+    with open(str(DATA_DIR / target) + '.csv', 'r', newline='', encoding='utf-8') as src:
+        for row in csv.DictReader(src):
+            hashtags.update(w[1:] if w[0] == '#' else w for w in row['text'].split() if '#' in w)
+            yield row['text']
+
+def stream_summary(target, lang='en', max_sentence_len=30):
+    '''
+    Summarizes every tweet of a topic in one pass over its purified file,
+    using memory that doesn't grow with the corpus. Word and hashtag counts
+    are kept in HeavyHitters sketches of SUMMARY_MAX_TERMS words. The best
+    SUMMARY_CANDIDATES sentences so far, scored against the counts so far,
+    are kept on a heap. The summary is then picked from those, scored against
+    the final counts, with the same filters as core_summary_function.
+    '''
+    _target = target[1:]
+    word_counts = HeavyHitters(SUMMARY_MAX_TERMS)
+    hashtags = HeavyHitters(SUMMARY_MAX_TERMS)
+    heap = []       # (score, -order, sentence, words), worst on top
+    pooled = set()  # stripped sentences in the heap
+    max_count = 1
+    order = 0
+    for doc in parse(_read_texts(target, hashtags), lang, use_cache=False):
+        doc_words = [word.text.strip(punctuation).lower() for word in doc]
+        word_counts.update(doc_words)
+        counts = word_counts.counts
+        max_count = max([max_count] + [counts[w] for w in doc_words])
+        for sent in doc.sents:
+            text = sent.text.strip()
+            if len(sent) <= 2 or _is_repeat_sentence(sent.text) or text in pooled:
+                continue
+            if len(sent.text.split(' ')) >= max_sentence_len:
+                continue
+            sent_words = [word.text.lower() for word in sent if word.text != _target]
+            score = sum(counts[w] for w in sent_words if w not in STOP_WORDS and w not in hashtags.counts) / max_count
+            entry = (score, -order, sent.text, sent_words)
+            order += 1
+            if len(heap) < SUMMARY_CANDIDATES:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                pooled.discard(heapq.heappushpop(heap, entry)[2].strip())
+            else:
+                continue
+            pooled.add(text)
+
+    word_freq = {w: count for (w, count) in word_counts.counts.items() if w not in STOP_WORDS and w not in hashtags.counts}
+    max_freq = max(word_freq.values())
+
+    # Rescore the candidates against the final counts, earliest first among
+    # equal scores.
+    sent_scores = []
+    for (_, neg_order, sent, sent_words) in heap:
+        in_table = [w for w in sent_words if w in word_freq]
+        if in_table:
+            sent_scores.append((sum(word_freq[w] for w in in_table) / max_freq, neg_order, sent))
+    summarized_sentences = [sent for (_, _, sent) in sorted(sent_scores, reverse=True)[:NUM_SENTENCE_SUMMARY]]
+    return _format_summary(summarized_sentences)
+
 def summarize_tweets(target, mock):
     '''Summarizes tweets passed in from zeitgeist'''
     selection = sample(target)
@@ -157,12 +364,22 @@ def summarize_tweets(target, mock):
         sentences = selection[:NUM_SENTENCE_SUMMARY]
         return ''.join(t['text'] for t in sentences)
 
-    log(f'Summarizing {len(selection)} tweets from {target}...')
-    top_n_tweets = get_top_tweets(selection,
-                                  num_likes=r.randint(100, 300),
-                                  num_retweets=r.randint(100, 300))
+    if SUMMARY_ENGINE == 'stream':
+        log(f'Summarizing all tweets from {target}...')
+        return stream_summary(target)
+
+    num_likes = r.randint(100, 300)
+    num_retweets = r.randint(100, 300)
+    if store.is_fresh(DATA_DIR, target):
+        log(f'Summarizing the most popular tweets from {target}...')
+        top_n_tweets = top_tweets(target, num_likes, num_retweets)
+    else:
+        log(f'Summarizing {len(selection)} tweets from {target}...')
+        # Copies of a tweet would only crowd each other out of the top tweets
+        selection, _, _ = dedup.collapse(selection)
+        top_n_tweets = get_top_tweets(selection, num_likes, num_retweets)
     log(f'Selected top {len(top_n_tweets)} tweets')
-    corpus = ''.join([row['text'] for row in top_n_tweets])
+    corpus = [row['text'] for row in top_n_tweets]
     summary = core_summary_function(corpus, target)
     return summary
 
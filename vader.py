@@ -0,0 +1,319 @@
+#
+# authors:
+#   Paul Galatic
+#
+# description:
+#   A batch version of the VADER sentiment scorer. Tweets are tokenized the
+#   way vaderSentiment tokenizes them, but the lexicon is compiled to arrays
+#   indexed by token id, and the rules (boosters, capitals, negations, idioms,
+#   "least" and "but") are applied to a whole chunk of tweets at once, over a
+#   matrix of token ids padded to the longest tweet in the chunk. Scores match
+#   SentimentIntensityAnalyzer.polarity_scores to within VADER_TOLERANCE; run
+#   this file to check that against the reference.
+#
+
+# STD LIB
+import string
+import functools
+import itertools
+
+# EXTERNAL LIB
+import numpy as np
+from vaderSentiment import vaderSentiment as reference
+
+# PROJECT LIB
+from extern import *
+
+# CONSTANTS
+SPECIAL_WORDS = ['kind', 'of', 'least', 'at', 'very', 'never', 'so', 'this', 'without', 'doubt', 'but']
+PUNCTUATION = set(string.punctuation)
+# Scalars applied to boosters 1, 2 and 3 words before a lexicon word.
+DISTANCE_DAMPING = [1.0, 0.95, 0.9]
+
+class Lexicon:
+    '''
+    The VADER lexicon and rule words, compiled to arrays indexed by token id.
+    Id 0 stands for every word the rules have no use for.
+    '''
+    def __init__(self):
+        analyzer = reference.SentimentIntensityAnalyzer()
+        self.emojis = analyzer.emojis
+
+        words = set(analyzer.lexicon) | set(reference.NEGATE) | set(SPECIAL_WORDS)
+        for phrase in itertools.chain(reference.BOOSTER_DICT, reference.SPECIAL_CASE_IDIOMS):
+            words.update(phrase.split())
+        self.ids = {word: idx for idx, word in enumerate(sorted(words), 1)}
+        self.word = {word: self.ids[word] for word in SPECIAL_WORDS}
+
+        size = len(self.ids) + 1
+        self.in_lexicon = np.zeros(size, dtype=bool)
+        self.valence = np.zeros(size)
+        for word, valence in analyzer.lexicon.items():
+            self.in_lexicon[self.ids[word]] = True
+            self.valence[self.ids[word]] = valence
+        self.negation = np.zeros(size, dtype=bool)
+        self.negation[[self.ids[word] for word in reference.NEGATE]] = True
+        self.booster = np.zeros(size)
+        self.booster_phrases = []
+        for phrase, scalar in reference.BOOSTER_DICT.items():
+            if ' ' in phrase:
+                self.booster_phrases.append((self.phrase(phrase), scalar))
+            else:
+                self.booster[self.ids[phrase]] = scalar
+        self.idioms = [(self.phrase(phrase), value) for phrase, value in reference.SPECIAL_CASE_IDIOMS.items()]
+
+    def phrase(self, text):
+        return [self.ids[word] for word in text.split()]
+
+@functools.lru_cache(maxsize=None)
+def lexicon():
+    return Lexicon()
+
+def tokenize(text, lex):
+    '''
+    Splits a tweet into words and emoticons the way vaderSentiment does,
+    after replacing emojis with their descriptions. Returns the tokens and
+    the text they came from.
+    '''
+    text = ' '.join(lex.emojis.get(token, token) for token in text.split())
+    words_only = {word for word in reference.REGEX_REMOVE_PUNCTUATION.sub('', text).split() if len(word) > 1}
+    tokens = []
+    for token in text.split():
+        if len(token) <= 1:
+            continue
+        # Strip punctuation from either end of a word, if that leaves a word.
+        if token[-1] in PUNCTUATION:
+            for punc in reference.PUNC_LIST:
+                if token.endswith(punc) and token[:-len(punc)] in words_only:
+                    token = token[:-len(punc)]
+                    break
+        if token[0] in PUNCTUATION:
+            for punc in reference.PUNC_LIST:
+                if token.startswith(punc) and token[len(punc):] in words_only:
+                    token = token[len(punc):]
+                    break
+        tokens.append(token)
+    return tokens, text
+
+def _shift(matrix, k, fill):
+    '''Moves each row of a matrix k columns right (or left, if k < 0).'''
+    shifted = np.full_like(matrix, fill)
+    if k > 0:
+        shifted[:, k:] = matrix[:, :-k]
+    elif k < 0:
+        shifted[:, :k] = matrix[:, -k:]
+    else:
+        shifted[:] = matrix
+    return shifted
+
+def _but_check(sentiments, but):
+    '''vaderSentiment's adjustment of scores around the word at index but.'''
+    for sentiment in sentiments:
+        idx = sentiments.index(sentiment)
+        if idx < but:
+            sentiments[idx] = sentiment * 0.5
+        elif idx > but:
+            sentiments[idx] = sentiment * 1.5
+    return sentiments
+
+def score_chunk(texts, lex):
+    '''Scores a chunk of tweets. See score().'''
+    num = len(texts)
+    ids, upper, negated, first = [], [], [], []
+    lengths = np.zeros(num, dtype=np.int64)
+    bangs = np.zeros(num)
+    questions = np.zeros(num)
+    for row, text in enumerate(texts):
+        tokens, text = tokenize(text, lex)
+        lengths[row] = len(tokens)
+        bangs[row] = min(text.count('!'), 4)
+        questions[row] = text.count('?')
+        seen = {}
+        for pos, token in enumerate(tokens):
+            lower = token.lower()
+            ids.append(lex.ids.get(lower, 0))
+            upper.append(token.isupper())
+            negated.append("n't" in lower)
+            # vaderSentiment looks up each token's context with list.index(),
+            # so a repeated token is scored as if it were its first copy.
+            first.append(seen.setdefault(token, pos))
+
+    width = max(int(lengths.max()) if num else 0, 1)
+    rows = np.repeat(np.arange(num), lengths)
+    cols = np.arange(len(ids)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+    def pad(flat, dtype):
+        matrix = np.zeros((num, width), dtype=dtype)
+        matrix[rows, cols] = flat
+        return matrix
+
+    ids = pad(ids, np.int64)
+    upper = pad(upper, bool)
+    negated = pad(negated, bool) | lex.negation[ids]
+    first = pad(first, np.int64)
+    valid = pad(np.ones(len(rows), dtype=bool), bool)
+    pos = np.arange(width)[None, :]
+    num_upper = upper.sum(axis=1)
+    cap_diff = ((num_upper > 0) & (num_upper < lengths))[:, None]
+
+    def before(k):
+        '''The id of the token k places before each token (0 off the end).'''
+        return _shift(ids, k, 0)
+
+    def is_word(k, word):
+        return before(k) == lex.word[word]
+
+    def matches(offset, phrase):
+        '''Where the phrase starts offset places after each token.'''
+        found = np.ones(ids.shape, dtype=bool)
+        for idx, word in enumerate(phrase):
+            found &= before(-(offset + idx)) == word
+        return found
+
+    # Lexicon words, emphasized by capitals if only some words are capitals.
+    in_lexicon = lex.in_lexicon[ids]
+    valence = lex.valence[ids]
+    valence = valence + np.where(upper & cap_diff, np.where(valence > 0, reference.C_INCR, -reference.C_INCR), 0)
+
+    for k in range(3):
+        prev = before(k + 1)
+        applies = (pos > k) & ~lex.in_lexicon[prev]
+
+        # Boosters and dampeners up to three words back.
+        scalar = lex.booster[prev]
+        boost = np.where(valence < 0, -scalar, scalar)
+        boost += np.where((scalar != 0) & _shift(upper, k + 1, False) & cap_diff,
+            np.where(valence > 0, reference.C_INCR, -reference.C_INCR), 0)
+        valence = np.where(applies, valence + boost * DISTANCE_DAMPING[k], valence)
+
+        # Negations.
+        negated_prev = _shift(negated, k + 1, False)
+        so_this_1 = is_word(1, 'so') | is_word(1, 'this')
+        if k == 0:
+            factor = np.where(negated_prev, reference.N_SCALAR, 1)
+        elif k == 1:
+            factor = np.where(is_word(2, 'never') & so_this_1, 1.25,
+                np.where(is_word(2, 'without') & is_word(1, 'doubt'), 1,
+                np.where(negated_prev, reference.N_SCALAR, 1)))
+        else:
+            factor = np.where((is_word(3, 'never') & (is_word(2, 'so') | is_word(2, 'this'))) | so_this_1, 1.25,
+                np.where(is_word(3, 'without') & (is_word(2, 'doubt') | is_word(1, 'doubt')), 1,
+                np.where(negated_prev, reference.N_SCALAR, 1)))
+        valence = np.where(applies, valence * factor, valence)
+
+        # Idioms, checked once three words back are in range.
+        if k == 2:
+            idiom = np.full(ids.shape, np.nan)
+            # The first of these sequences to be an idiom wins.
+            for offset, length in reversed([(-1, 2), (-2, 3), (-2, 2), (-3, 3), (-3, 2)]):
+                for phrase, value in lex.idioms:
+                    if len(phrase) == length:
+                        idiom = np.where(matches(offset, phrase), value, idiom)
+            with_idioms = np.where(np.isnan(idiom), valence, idiom)
+            for offset, length in [(0, 2), (0, 3)]:
+                for phrase, value in lex.idioms:
+                    if len(phrase) == length:
+                        with_idioms = np.where(matches(offset, phrase), value, with_idioms)
+            for offset, length in [(-3, 3), (-3, 2), (-2, 2)]:
+                for phrase, scalar in lex.booster_phrases:
+                    if len(phrase) == length:
+                        with_idioms = with_idioms + np.where(matches(offset, phrase), scalar, 0)
+            valence = np.where(applies, with_idioms, valence)
+
+    # "least" negates, unless it's "at least" or "very least".
+    least = (before(1) == lex.word['least']) & ~lex.in_lexicon[before(1)]
+    valence = valence * np.where((pos > 1) & least,
+        np.where(is_word(2, 'at') | is_word(2, 'very'), 1, reference.N_SCALAR),
+        np.where((pos > 0) & least, reference.N_SCALAR, 1))
+
+    # Boosters, and "kind" in "kind of", carry no sentiment of their own.
+    kind_of = (ids == lex.word['kind']) & (before(-1) == lex.word['of'])
+    sentiments = np.where(valid & in_lexicon & (lex.booster[ids] == 0) & ~kind_of, valence, 0)
+    sentiments = np.where(valid, np.take_along_axis(sentiments, first, axis=1), 0)
+
+    # Words before the first "but" count half as much, and words after it half
+    # again as much. vaderSentiment finds each word by its score rather than
+    # its position, which goes astray when scores repeat, so the few rows with
+    # a "but" are replayed its way.
+    is_but = valid & (ids == lex.word['but'])
+    for row in np.flatnonzero(is_but.any(axis=1)):
+        sentiments[row, :lengths[row]] = _but_check(sentiments[row, :lengths[row]].tolist(), is_but[row].argmax())
+
+    # Punctuation emphasis, and the final scores.
+    emphasis = bangs * 0.292 + np.where(questions > 1, np.where(questions <= 3, questions * 0.18, 0.96), 0)
+    # Summed left to right, as vaderSentiment does, so that scores which cancel
+    # out come to exactly 0.
+    total = sentiments.cumsum(axis=1)[:, -1]
+    total = np.where(total > 0, total + emphasis, np.where(total < 0, total - emphasis, total))
+    compound = np.clip(total / np.sqrt(total * total + 15), -1, 1)
+
+    pos_sum = np.where(sentiments > 0, sentiments + 1, 0).cumsum(axis=1)[:, -1]
+    neg_sum = np.where(sentiments < 0, sentiments - 1, 0).cumsum(axis=1)[:, -1]
+    neu_count = (valid & (sentiments == 0)).sum(axis=1)
+    pos_sum, neg_sum = (
+        np.where(pos_sum > np.abs(neg_sum), pos_sum + emphasis, pos_sum),
+        np.where(pos_sum < np.abs(neg_sum), neg_sum - emphasis, neg_sum))
+    denominator = pos_sum + np.abs(neg_sum) + neu_count
+    denominator = np.where(lengths > 0, denominator, 1)
+
+    scores = np.zeros((num, 4), dtype=np.float32)
+    scores[:, 0] = np.round(np.where(lengths > 0, compound, 0), 4)
+    scores[:, 1] = np.round(np.abs(pos_sum / denominator), 3)
+    scores[:, 2] = np.round(np.abs(neg_sum / denominator), 3)
+    scores[:, 3] = np.round(np.abs(neu_count / denominator), 3)
+    return scores
+
+def score(texts):
+    '''
+    Scores tweets in chunks of SENTIMENT_CHUNK_ROWS. Returns a float32 array
+    of compound, pos, neg and neu for each tweet, in order.
+    '''
+    lex = lexicon()
+    chunks = [score_chunk(texts[idx:idx + SENTIMENT_CHUNK_ROWS], lex) for idx in range(0, len(texts), SENTIMENT_CHUNK_ROWS)]
+    return np.concatenate(chunks) if chunks else np.empty((0, 4), dtype=np.float32)
+
+def _corpus(size=5000, seed=0):
+    '''A fixed corpus of made-up tweets that exercises every rule.'''
+    rng = np.random.RandomState(seed)
+    pool = [
+        'good', 'GOOD', 'bad', 'BAD', 'love', 'hate', 'great', 'horrible', 'ok', 'sux', 'lol', ':)', ':(',
+        'not', "isn't", "don't", 'never', 'without', 'doubt', 'least', 'at', 'very', 'VERY', 'so', 'this',
+        'kind', 'of', 'sort', 'kinda', 'just', 'enough', 'extremely', 'barely', 'uber', 'FRIGGIN',
+        'but', 'BUT', 'the', 'shit', 'bomb', 'yeah', 'right', 'kiss', 'death', 'bad', 'ass',
+        'wall', 'border', 'trump', 'today', 'is', 'was', 'a', 'I', 'you', 'it', 'and',
+        'good!', 'bad.', 'great,', '"love"', 'hate?', '!!!', '??', '?', '!', 'funny!!', '\U0001f498', '\U0001f601',
+    ]
+    corpus = [
+        'VADER is smart, handsome, and funny.',
+        'VADER is VERY SMART, uber handsome, and FRIGGIN FUNNY!!!',
+        'VADER is not smart, handsome, nor funny.',
+        "At least it isn't a horrible book.",
+        'The book was only kind of good.',
+        'The plot was good, but the characters are uncompelling and the dialog is not great.',
+        "Today only kinda sux! But I'll get by, lol",
+        'Make sure you :) or :D today!',
+        'Catch utf-8 emoji such as \U0001f498 and \U0001f48b and \U0001f601',
+        'Not bad at all',
+        '',
+        '!!!',
+    ]
+    for _ in range(size):
+        corpus.append(' '.join(rng.choice(pool, rng.randint(1, 25))))
+    return corpus
+
+def _test():
+    '''Checks scores against the reference analyzer on a fixed corpus.'''
+    corpus = _corpus()
+    analyzer = reference.SentimentIntensityAnalyzer()
+    expected = np.array([[scores[key] for key in ('compound', 'pos', 'neg', 'neu')]
+        for scores in map(analyzer.polarity_scores, corpus)])
+    actual = score(corpus)
+    error = np.abs(actual - expected)
+    log(f'Scored {len(corpus)} tweets, largest differences (compound, pos, neg, neu): {error.max(axis=0).round(4)}')
+    mismatched = np.flatnonzero((error > VADER_TOLERANCE).any(axis=1))
+    for idx in mismatched[:10]:
+        log(f'\t{corpus[idx]!r}: expected {expected[idx]}, got {actual[idx]}')
+    assert len(mismatched) == 0, f'{len(mismatched)} tweets differ by more than {VADER_TOLERANCE}'
+
+if __name__ == '__main__':
+    _test()
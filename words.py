@@ -0,0 +1,120 @@
+#
+# authors:
+#   Paul Galatic
+#
+# description:
+#   Tokenizes and normalizes tweets for clustering. Tokens are kept for each
+#   topic, keyed by tweet index, along with a mask of which are stopwords. If
+#   TOKEN_CACHE_PERSIST is set they are saved to CACHE_DIR, so later runs on
+#   the same topic (re-clustering the sample, sweeps over thresholds) don't
+#   tokenize the tweets again. Spelling corrections are made a word at a time
+#   and remembered across runs.
+#
+
+# STD LIB
+import os
+import json
+import functools
+from string import punctuation
+
+# EXTERNAL LIB
+import numpy as np
+
+# PROJECT LIB
+import cache
+from extern import *
+
+_TOKENS = {} # target -> {key: tokens}
+_MASKS = {}  # target -> {key: stopword mask}
+_SPELLINGS = None
+
+@functools.lru_cache(maxsize=None)
+def stopwords():
+    '''Returns NLTK's set of English stopwords, loading it only once per run.'''
+    if not os.path.exists(CACHE_DIR / 'stopwords.flag'):
+        import nltk
+        nltk.download('stopwords')
+        open(CACHE_DIR / 'stopwords.flag', 'w').close()
+    from nltk.corpus import stopwords as nltk_stopwords
+    return frozenset(nltk_stopwords.words('english'))
+
+def tokenize(text):
+    '''Splits a tweet into lowercase words, stripped of surrounding punctuation.'''
+    words = (word.strip(punctuation).lower() for word in text.split())
+    return [word for word in words if word]
+
+@functools.lru_cache(maxsize=None)
+def speller():
+    import autocorrect
+    return autocorrect.Speller(lang='en')
+
+@functools.lru_cache(maxsize=SPELL_CACHE_SIZE)
+def correct(word):
+    '''
+    Returns the spelling correction of a word. Corrections are remembered in
+    memory and in the 'spelling' table in CACHE_DIR, so each distinct word is
+    only ever corrected once. Few words make up most of a topic, so nearly
+    every lookup is answered from memory.
+    '''
+    global _SPELLINGS
+    if _SPELLINGS is None:
+        _SPELLINGS = cache.Table('spelling')
+    fixed = _SPELLINGS.get(word)
+    if fixed is None:
+        fixed = speller()(word)
+        _SPELLINGS.put(word, fixed)
+    return fixed
+
+def path(target):
+    '''Where the tokens of the current version of a topic's data are saved.'''
+    return sidecar(CACHE_DIR, target, f'tokens-{fingerprint(str(DATA_DIR / target) + ".csv")}.json')
+
+def _key(row):
+    return row['index'] or row['text']
+
+def _topic(target):
+    if target not in _TOKENS:
+        _TOKENS[target] = {}
+        if TOKEN_CACHE_PERSIST:
+            try:
+                with open(path(target), 'r') as src:
+                    _TOKENS[target] = json.load(src)
+            except (OSError, ValueError):
+                pass
+    return _TOKENS[target]
+
+def tokens(target, row):
+    '''Returns the tokens of a row of a topic, tokenizing it on first use.'''
+    cache = _topic(target)
+    key = _key(row)
+    if key not in cache:
+        cache[key] = tokenize(row['text'])
+    return cache[key]
+
+def stop_mask(target, row):
+    '''Returns a boolean array marking which of a row's tokens are stopwords.'''
+    masks = _MASKS.setdefault(target, {})
+    key = _key(row)
+    if key not in masks:
+        stops = stopwords()
+        masks[key] = np.array([word in stops for word in tokens(target, row)], dtype=bool)
+    return masks[key]
+
+def content_words(target, row):
+    '''Returns the tokens of a row that aren't stopwords.'''
+    return [word for word, stop in zip(tokens(target, row), stop_mask(target, row)) if not stop]
+
+def save(target):
+    '''
+    Saves the tokens of a topic to CACHE_DIR if TOKEN_CACHE_PERSIST is set,
+    removing those saved for older versions of its data.
+    '''
+    if not TOKEN_CACHE_PERSIST or target not in _TOKENS:
+        return
+    saved = path(target)
+    for old in os.listdir(CACHE_DIR):
+        if old.startswith(f'{target}.tokens-') and CACHE_DIR / old != saved:
+            os.remove(CACHE_DIR / old)
+    with open(str(saved) + '.tmp', 'w') as dst:
+        json.dump(_TOKENS[target], dst)
+    os.replace(str(saved) + '.tmp', saved)
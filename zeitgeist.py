@@ -25,6 +25,8 @@ import cluster
 import summarize
 import sentiment
 import report
+import rowindex
+import words
 from extern import *
 
 def arg_parser():
@@ -69,6 +71,12 @@ def arg_parser():
     # Default location of interest is the United States.
     ap.add_argument('--woeid', nargs='?', type=int, const=23424977, default=23424977,
         help='Can only be used wehn --gather==True. Yahoo \"Where On Earth\" ID. Trends will be sourced from this location. [23424977 (United States)]')
+    # Top up topics that have already been gathered instead of skipping them.
+    ap.add_argument('--append', action='store_true',
+        help='Can only be used when --gather==True. Add new tweets to topics that have already been gathered, resuming interrupted gathers. [False]')
+    # Number of topics to gather, or processes to purify or score with, at the same time.
+    ap.add_argument('--workers', nargs='?', type=int, const=None, default=None,
+        help=f'How many topics should be gathered at once, or how many processes should purify data and score sentiment? [{GATHER_WORKERS} topics, {PURIFY_WORKERS} processes]')
 
     return ap
 
@@ -84,7 +92,7 @@ def most_recent_file(dir):
     topic_name = os.path.splitext(os.path.basename(most_recent_file))[0]
     return topic_name
 
-def gather_data(woeid, num_topics):
+def gather_data(woeid, num_topics, workers=GATHER_WORKERS, append=False):
     # We have to validate our Twitter API before we run Gather.
     try:
         log('Validating Twitter API...')
@@ -103,24 +111,20 @@ def gather_data(woeid, num_topics):
         wait_on_rate_limit=True,
         wait_on_rate_limit_notify=True)
     # Trending tweets are stored in a CSV file in the /raw/ directory.
-    gather.trending_tweets(api, woeid, num_topics)
+    gather.trending_tweets(api, woeid, num_topics, workers, append=append)
 
 def deref(tweets, target):
     '''
     Given a list of tweets from DATA_DIR, replaces their text with the
-    corresponding text from the same tweet in RAW_DIR.
+    corresponding text from the same tweet in RAW_DIR. Only the rows that are
+    needed are read, using the row index of the raw file.
     '''
-    tweets = sorted(tweets, key=lambda x: int(x['index']))
-    with open(str(RAW_DIR / target) + '.csv', 'r', newline='', encoding='utf-8') as raw:
-        rdr = csv.DictReader(raw)
-        rows = [row for row in rdr]
-
-        for idx in range(len(tweets)):
-            original = rows[int(tweets[idx]['index'])]['text']
-            # perform basic data cleaning (there's no use in preserving urls, for example)
-            original = re.sub(r'http\S+', '[link]', original).replace('&amp;', '&')
-            # plug it back in where it came from
-            tweets[idx]['text'] = original
+    originals = rowindex.read_rows(RAW_DIR, target, [int(tweet['index']) for tweet in tweets])
+    for tweet, row in zip(tweets, originals):
+        # perform basic data cleaning (there's no use in preserving urls, for example)
+        original = re.sub(r'http\S+', '[link]', row['text']).replace('&amp;', '&')
+        # plug it back in where it came from
+        tweet['text'] = original
 
 def log_reps(reps):
     '''
@@ -132,7 +136,7 @@ def log_reps(reps):
         text = reps[idx][2]['text']
         log(f'Tweet:\t{text}')
 
-def process(target=None, mock=None, seed=None, label=None):
+def process(target=None, mock=None, seed=None, label=None, workers=None):
     '''
     Gathering data takes a long time, so if we want to process an existing
     dataset, we can use this function as shorthand.
@@ -147,22 +151,24 @@ def process(target=None, mock=None, seed=None, label=None):
         'mock': mock,
         'seed': seed,
         'label': label,
+        'workers': workers,
     })
 
 def partial(**kwargs):
     if kwargs.get('gather'):
         # If we want to gather data (or we're running everything), call the
         # Twitter API and gather as much as we can.
-        gather_data(kwargs.get('woeid'), kwargs.get('num_topics'))
+        gather_data(kwargs.get('woeid'), kwargs.get('num_topics'),
+            kwargs.get('workers') or GATHER_WORKERS, kwargs.get('append'))
     if kwargs.get('purify'):
         # If we want to clean data (or we're running everything), grab a target
         # and feed it through the data cleaning algorithm. If a target isn't
         # specified, the most recent file is used.
-        purify.cleanse(kwargs['purify'])
+        purify.cleanse(kwargs['purify'], kwargs.get('workers') or PURIFY_WORKERS)
     if kwargs.get('summarize'):
         # Same as above, but for text summarization.
         if not os.path.exists(str(DATA_DIR / kwargs['summarize']) + '.csv'):
-            purify.cleanse(kwargs['summarize'])
+            purify.cleanse(kwargs['summarize'], kwargs.get('workers') or PURIFY_WORKERS)
         try:
             summary = summarize.summarize_tweets(kwargs['summarize'], kwargs['mock'])
             if DEBUG: log(summary)
@@ -172,16 +178,22 @@ def partial(**kwargs):
     if kwargs.get('cluster'):
         # Find representative tweets using agglomerative clustering.
         if not os.path.exists(str(DATA_DIR / kwargs['cluster']) + '.csv'):
-            purify.cleanse(kwargs['cluster'])
+            purify.cleanse(kwargs['cluster'], kwargs.get('workers') or PURIFY_WORKERS)
         cluster_reps = cluster.find_cluster_reps(kwargs['cluster'], kwargs['mock'])
+        cluster_population = None if kwargs['mock'] else cluster.population(kwargs['cluster'])
         deref([rep[2] for rep in cluster_reps], kwargs['cluster'])
         if DEBUG: log_reps(cluster_reps)
     if kwargs.get('sentiment'):
         # Same as above, but for sentiment analysis
-        sent_reps = sentiment.find_sentiment_cluster_reps(kwargs['sentiment'], kwargs['mock'])
+        sent_reps = sentiment.find_sentiment_cluster_reps(kwargs['sentiment'], kwargs['mock'],
+            workers=kwargs.get('workers') or SENTIMENT_WORKERS)
         deref([rep[2] for rep in sent_reps], kwargs['sentiment'])
         if DEBUG: log_reps(sent_reps)
 
+    # Keep the tokens clustering made for later runs, if they're persisted.
+    if kwargs.get('cluster'):
+        words.save(kwargs['cluster'])
+
     if kwargs.get('report'):
         # Use the target for sentiment here (it is the same as the targets for
         # the other submodules when args.full or args.process is run).
@@ -190,6 +202,7 @@ def partial(**kwargs):
             sent_reps,
             kwargs.get('seed'),
             kwargs.get('label'),
+            cluster_population,
         )
 
 def main():
@@ -198,19 +211,19 @@ def main():
     args = parser.parse_args()
 
     # Set the random number generator seed if one has been provided.
-    if args.seed: np.random.seed(args.seed)
+    set_seed(args.seed)
     # We should NEVER mock a report without using a random seed.
     if args.mock and not (args.seed and args.label):
         raise Exception('Never mock a report without using a random seed and a label!')
 
     # If we want to run everything, then run everything.
     if args.full:
-        gather_data(args.woeid, args.num_topics)
-        process(most_recent_file(RAW_DIR), args.seed, args.label)
+        gather_data(args.woeid, args.num_topics, args.workers or GATHER_WORKERS, args.append)
+        process(most_recent_file(RAW_DIR), args.seed, args.label, workers=args.workers)
     # If we only want to process a specific target, then generate a report
     # without downloading any new data.
     elif args.process:
-        process(target=args.process, mock=args.mock, seed=args.seed, label=args.label)
+        process(target=args.process, mock=args.mock, seed=args.seed, label=args.label, workers=args.workers)
     # If we're doing things a-la-carte, then pass the arguments to partial().
     elif args.gather or args.purify or args.cluster or args.summarize or args.sentiment:
         partial(**vars(args))